@@ -1,29 +1,94 @@
-import py4DSTEM
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.spatial.transform import Rotation as R
-from tqdm import tqdm
 global full_path_tif
-from scipy.optimize import least_squares
 from PIL import Image
 import numpy
 import pandas as pd
+import hashlib
+import json
 import os
+import re
+import struct
+import sys
+import contextlib
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 import cv2
-import matplotlib.image as mpimg
-from scipy.optimize import curve_fit
+import timing
+from pattern_store import PatternStore, atomic_write, METADATA_FILENAME as STORE_METADATA_FILENAME
 
 directory_path = None
 
-def pre_process_image(filename):
-    # Load your image
-    image = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
-    
+# write the intermediate preprocessing images (Bright, Centered, Blowup, Resized and Processed_Exp.tif)
+# to ~/Downloads, only needed when checking the preprocessing steps by eye
+debug_output = False
+
+# matplotlib figure defaults that the original file based preprocessing rendered through
+FIGURE_DPI = 100
+FIGURE_SIZE = (6.4, 4.8)
+AXES_RECT = (0.125, 0.11, 0.775, 0.77)      # left, bottom, width, height of the default subplot
+BLOWUP_WIDTH = 11.05                        # width in inches of the blow-up figure
+PROCESSED_SIZE = 384
+
+
+# convert an image to 8 bit grayscale the way imshow(image, cmap='gray') displays it
+# grayscale images are stretched from their minimum to maximum, colour images are shown as they are
+def to_display_gray(image):
+    image = np.asarray(image)
+    if image.ndim == 3:
+        rgb = image[..., :3]
+        if np.issubdtype(rgb.dtype, np.floating):
+            rgb = np.clip(rgb * 255, 0, 255)
+        return cv2.cvtColor(rgb.astype(np.uint8), cv2.COLOR_RGB2GRAY)
+
+    image = image.astype(np.float64)
+    low, high = image.min(), image.max()
+    if high <= low:
+        return np.zeros(image.shape, dtype=np.uint8)
+    return np.minimum((image - low) / (high - low) * 256, 255).astype(np.uint8)
+
+
+# size in (fractional) pixels that an image with equal aspect ratio is drawn at inside the default axes of a figure
+def _axes_image_size(image_shape, figure_width, figure_height):
+    axes_width = AXES_RECT[2] * figure_width
+    axes_height = AXES_RECT[3] * figure_height
+    scale = min(axes_width / image_shape[1], axes_height / image_shape[0])
+    return image_shape[1] * scale, image_shape[0] * scale
+
+
+def _resize(image, width, height):
+    shrinking = width < image.shape[1] or height < image.shape[0]
+    return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR)
+
+
+# what saving a default matplotlib figure with a black face colour showing the image produces:
+# the grayscale image drawn in the default axes of a 640 x 480 black canvas
+def render_figure(image):
+    gray = to_display_gray(image)
+    figure_width, figure_height = FIGURE_SIZE[0] * FIGURE_DPI, FIGURE_SIZE[1] * FIGURE_DPI
+    width, height = _axes_image_size(gray.shape, figure_width, figure_height)
+
+    # the image is centred in the axes and its edges are snapped to the nearest pixel,
+    # y is measured from the top of the canvas
+    center_x = (AXES_RECT[0] + AXES_RECT[2] / 2) * figure_width
+    center_y = (1 - AXES_RECT[1] - AXES_RECT[3] / 2) * figure_height
+    left, right = int(round(center_x - width / 2)), int(round(center_x + width / 2))
+    top, bottom = int(round(center_y - height / 2)), int(round(center_y + height / 2))
+
+    canvas = np.zeros((int(figure_height), int(figure_width)), dtype=np.uint8)
+    canvas[top:bottom, left:right] = _resize(gray, max(1, right - left), max(1, bottom - top))
+    return canvas
+
+
+# shift the image so the center of mass of the bright (> 127) pattern is in the middle
+def center_pattern(image):
     # Thresholding to segment the TEM pattern
     _, binary_image = cv2.threshold(image, 127, 255, cv2.THRESH_BINARY)
     
     # Calculate the center of mass
     M = cv2.moments(binary_image)
+    if M["m00"] == 0:
+        return image    # nothing above the threshold, leave the image where it is
     center_x = int(M["m10"] / M["m00"])
     center_y = int(M["m01"] / M["m00"])
     
@@ -36,74 +101,47 @@ def pre_process_image(filename):
     
     # Shift the image
     shifted_image = np.roll(image, shift_x, axis=1)
-    shifted_image = np.roll(shifted_image, shift_y, axis=0)
-    
-    # Save the centered image 
-    downloads_folder = os.path.expanduser("~/Downloads")
+    return np.roll(shifted_image, shift_y, axis=0)
 
-    # Save the figure
-    center_output_filename = os.path.join(downloads_folder, "Centered_Exp.tif")
-    cv2.imwrite(center_output_filename, shifted_image)
 
-    
-    #start scaling the image
-    image = plt.imread(center_output_filename)
-    # Get the aspect ratio of the image
-    aspect_ratio = image.shape[1] / image.shape[0]
-    
-    # Set the size of the figure based on the aspect ratio
-    fig_width = 11.05 # Adjust as needed
-    fig_height = fig_width / aspect_ratio
-    
-    # Create a figure with the specified size and background color
-    fig = plt.figure(figsize=(fig_width, fig_height), facecolor='black')
-    
-    # Display the image in grayscale
-    plt.imshow(image, cmap='gray')
-    
-    # Turn off axis
-    plt.axis('off')
-    
-    # Save the displayed image
-    blowup_output_filename = os.path.join(downloads_folder, "Blowup_Exp.tif")
-    plt.savefig(blowup_output_filename, bbox_inches='tight', pad_inches=0)
-    # Close the figure to release memory
-    plt.close(fig)
-
-    #start the resize
-    image = cv2.imread(blowup_output_filename, cv2.IMREAD_GRAYSCALE)
-    
+# scale the image the way the blow-up figure did: an 11.05 inch wide figure saved with a tight
+# bounding box keeps only the image, drawn at the size it takes up inside the default axes
+def blow_up(image):
+    figure_width = BLOWUP_WIDTH * FIGURE_DPI
+    figure_height = figure_width / (image.shape[1] / image.shape[0])
+    width, height = _axes_image_size(image.shape, figure_width, figure_height)
+    # the saved tight bounding box is truncated to whole pixels
+    return _resize(to_display_gray(image), max(1, int(width)), max(1, int(height)))
+
+
+# crop the centre of the image and resize it to size x size
+def crop_center(image, size=PROCESSED_SIZE):
     # Get the center of the image
     center_x, center_y = image.shape[1] // 2, image.shape[0] // 2
     
-    # Calculate the desired dimensions of the resized image
-    desired_width, desired_height = 384, 384
-    
     # Calculate the cropping region
-    left = max(0, center_x - desired_width // 2)
-    top = max(0, center_y - desired_height // 2)
-    right = min(image.shape[1], center_x + desired_width // 2)
-    bottom = min(image.shape[0], center_y + desired_height // 2)
+    left = max(0, center_x - size // 2)
+    top = max(0, center_y - size // 2)
+    right = min(image.shape[1], center_x + size // 2)
+    bottom = min(image.shape[0], center_y + size // 2)
     
     # Crop the region containing the TEM pattern
     cropped_region = image[top:bottom, left:right]
     
     # Resize the cropped region to the desired dimensions
-    resized_cropped_region = cv2.resize(cropped_region, (desired_width, desired_height), interpolation=cv2.INTER_LINEAR)
-    
-    # Save the final image
-    resize_output_filename = os.path.join(downloads_folder, "Resized_Exp.tif")
-    cv2.imwrite(resize_output_filename, resized_cropped_region)
-#beginnning the rotattion for the image
-    # Load your image
-    image = cv2.imread(resize_output_filename, cv2.IMREAD_GRAYSCALE)
-    
+    return cv2.resize(cropped_region, (size, size), interpolation=cv2.INTER_LINEAR)
+
+
+# rotate the image so the largest edge contour (the pattern disk) has a fixed orientation
+def rotate_pattern(image):
     # Preprocess the image (e.g., apply Gaussian blur, edge detection)
     blurred_image = cv2.GaussianBlur(image, (5, 5), 0)
     edges = cv2.Canny(blurred_image, 50, 150)
     
     # Find contours in the edge-detected image
     contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    # fitEllipse needs at least 5 points
+    contours = [contour for contour in contours if len(contour) >= 5]
     # Calculate the orientation angle of the largest contour
     if contours:
         # Select the largest contour based on area
@@ -112,7 +150,8 @@ def pre_process_image(filename):
         ellipse = cv2.fitEllipse(largest_contour)
         # Extract the angle of rotation from the fitted ellipse
         rotation_angle = ellipse[2]
-        print("Orientation from horizontal:", rotation_angle, "degrees")
+        # diagnostic only, on standard error so it never mixes with results written to standard output
+        print("Orientation from horizontal:", rotation_angle, "degrees", file=sys.stderr)
         # Adjust rotation angle to orient the image correctly
         if ellipse[1][1] > ellipse[1][0]:
             rotation_angle -= (180 - rotation_angle)
@@ -122,21 +161,149 @@ def pre_process_image(filename):
     # Rotate the image by the calculated angle
     center_x, center_y = image.shape[1] // 2, image.shape[0] // 2
     rotation_matrix = cv2.getRotationMatrix2D((center_x, center_y), rotation_angle, 1.0)
-    rotated_image = cv2.warpAffine(image, rotation_matrix, (image.shape[1], image.shape[0]), flags=cv2.INTER_LINEAR)
-    
-    # Save the rotated image
-    global processed_output_file
-    processed_output_filename = os.path.join(downloads_folder, "Processed_Exp.tif")
-    cv2.imwrite(processed_output_filename, rotated_image)
-    os.remove(center_output_filename)
-    os.remove(blowup_output_filename)
-    os.remove(resize_output_filename)
+    return cv2.warpAffine(image, rotation_matrix, (image.shape[1], image.shape[0]), flags=cv2.INTER_LINEAR)
+
+
+# save one preprocessing step to ~/Downloads for inspection
+def write_debug_image(name, image):
+    downloads_folder = os.path.expanduser("~/Downloads")
+    cv2.imwrite(os.path.join(downloads_folder, name), image)
+
+
+# in-memory preprocessing of a grayscale experimental image (already rendered with render_figure
+# when it comes straight from the microscope), returns the centered, cropped, resized and rotated
+# PROCESSED_SIZE x PROCESSED_SIZE uint8 array that is matched against the simulations
+def pre_process_array(image, debug=None):
+    debug = debug_output if debug is None else debug
+
+    image = np.asarray(image)
+    if image.ndim == 3 or image.dtype != np.uint8:
+        image = to_display_gray(image)
+
+    with timing.stage('center'):
+        centered = center_pattern(image)
+    with timing.stage('blow_up'):
+        blown_up = blow_up(centered)
+    with timing.stage('crop'):
+        resized = crop_center(blown_up)
+    with timing.stage('rotate'):
+        processed = rotate_pattern(resized)
+
+    if debug:
+        with timing.stage('debug_write'):
+            write_debug_image("Centered_Exp.tif", centered)
+            write_debug_image("Blowup_Exp.tif", blown_up)
+            write_debug_image("Resized_Exp.tif", resized)
+            write_debug_image("Processed_Exp.tif", processed)
+    return processed
+
+
+# bump when a preprocessing step changes so that cached results of the old steps are no longer used
+PREPROCESS_VERSION = 1
+PREPROCESS_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ecen_403_tem", "preprocess")
+PREPROCESS_CACHE_ENTRIES = 500      # about 150 kB each
+
+
+# processed experimental images stored on disk under a hash of the image file bytes and the preprocessing
+# parameters, so preprocessing the same image again (or matching it against another library) is a file read
+# the least recently used entries are removed once the cache holds more than max_entries images
+class PreprocessCache:
+    def __init__(self, directory=PREPROCESS_CACHE_DIR, max_entries=PREPROCESS_CACHE_ENTRIES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+    # cache key of the contents of an image file
+    def key(self, data):
+        params = repr((PREPROCESS_VERSION, FIGURE_DPI, FIGURE_SIZE, AXES_RECT, BLOWUP_WIDTH, PROCESSED_SIZE))
+        return hashlib.sha256(data + params.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    # the cached processed image, or None
+    def get(self, key):
+        path = self.path(key)
+        try:
+            processed = np.load(path)
+            os.utime(path)      # mark as recently used
+            return processed
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, processed):
+        with self.lock:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                with atomic_write(self.path(key)) as file:
+                    np.save(file, processed)
+                self.evict()
+            except OSError:
+                pass    # the cache is only a shortcut, preprocessing still works without it
+
+    # remove the least recently used entries above max_entries
+    def evict(self):
+        entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith('.npy')]
+        if len(entries) > self.max_entries:
+            entries.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in entries[:len(entries) - self.max_entries]:
+                with contextlib.suppress(FileNotFoundError):     # already evicted by another process
+                    os.remove(entry.path)
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            for entry in os.scandir(self.directory):
+                os.remove(entry.path)
+
+
+# cache used by pre_process_file, set to None to always preprocess
+preprocess_cache = PreprocessCache()
+
+
+# read and preprocess an experimental image file the way the GUI does (rendered with render_figure, then
+# pre_process_array), returning the cached result when the same file contents were processed before
+# the cache is skipped while debug_output is set so the intermediate images are always written
+def pre_process_file(filePath, cache=None):
+    cache = preprocess_cache if cache is None else cache
+    use_cache = cache is not None and not debug_output
+    if use_cache:
+        with timing.stage('cache_lookup'):
+            with open(filePath, 'rb') as file:
+                key = cache.key(file.read())
+            processed = cache.get(key)
+        if processed is not None:
+            return processed
+
+    with timing.stage('decode', file=filePath):
+        import matplotlib.image as mpimg
+        image = mpimg.imread(filePath)
+    with timing.stage('render'):
+        bright_image = render_figure(image)
+    if debug_output:
+        with timing.stage('debug_write'):
+            write_debug_image("Bright_Exp.tif", bright_image)
+    processed = pre_process_array(bright_image)
+    if use_cache:
+        with timing.stage('cache_store'):
+            cache.put(key, processed)
+    return processed
+
+
+# preprocess an image file and save the result as Processed_Exp.tif in ~/Downloads
+# returns the path of the processed image
+def pre_process_image(filename):
+    # Load your image
+    with timing.stage('decode', file=filename):
+        image = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
+    processed = pre_process_array(image)
+
+    processed_output_filename = os.path.join(os.path.expanduser("~/Downloads"), "Processed_Exp.tif")
+    with timing.stage('write', file=processed_output_filename):
+        cv2.imwrite(processed_output_filename, processed)
     return processed_output_filename
 
 
 def get_best_image(filename, images):
-        def linear_func(x, a, b):
-            return a * x + b
         #opening both the input file and the 
         #simulated files
         img = Image.open(filename)
@@ -148,17 +315,904 @@ def get_best_image(filename, images):
         img2 = Image.open(full_path_tif).convert('L')
         imarray = numpy.array(img)
         imarray2 = numpy.array(img2)
-        #reshape images into 1D arrays
-        flatten_image1 = imarray.reshape(-1) # flatten the array into a 1D vector
-        flatten_image2 = imarray2.reshape(-1) # flatten the array into a 1D vector
-        imarray = numpy.array(flatten_image1)
-        imarray2 = numpy.array(flatten_image2)
-        #using curve fit, best for non-linear least square fitting methods
-        params1, _ = curve_fit(linear_func, flatten_image1, flatten_image2)
-        #creating the desired linear function using the input picture
-        #and the paramters to create a line that should be comapred to
-        fitted_line = linear_func(flatten_image1, *params1)
-        mse = (np.mean((flatten_image2 - fitted_line) ** 2))/100
+        #reshape the simulation into a single row so it can be scored
+        #with the same closed-form linear fit used for whole libraries
+        flatten_image2 = imarray2.reshape(1, -1)
+        mse = score_library(imarray, flatten_image2)[0]
         #print(full_path_tif)
         #print(f'Mean Squared Error percentage: {mse}')
-        return mse, full_path_tif
\ No newline at end of file
+        return mse, full_path_tif
+
+
+# file extensions treated as simulation images when scanning a directory
+SIMULATION_EXTENSIONS = ('.tif', '.tiff')
+
+
+# list the simulation images in a directory
+# sorted so that score arrays always line up with the same file order
+def list_simulations(directory):
+    names = sorted(name for name in os.listdir(directory) if name.lower().endswith(SIMULATION_EXTENSIONS))
+    return [os.path.join(directory, name) for name in names]
+
+
+# simulations decoded between two progress reports while a library is built
+DECODE_PROGRESS_STEP = 16
+
+
+# report that done of total simulations of a library build are decoded, every DECODE_PROGRESS_STEP simulations and
+# at the end, and stop the build with MatchCancelled once the cancel event (a threading.Event) is set
+def _build_progress(done, total, progress=None, cancel=None):
+    if cancel is not None and cancel.is_set():
+        raise MatchCancelled()
+    if progress is not None and (done % DECODE_PROGRESS_STEP == 0 or done == total):
+        progress(done, total)
+
+
+# decode simulation images into one (N, H*W) grayscale matrix
+# each row is one flattened simulation, in the same order as paths
+# progress(done, total) and cancel work like they do for score_library
+def stack_simulations(paths, progress=None, cancel=None):
+    first = numpy.array(Image.open(paths[0]).convert('L'))
+    sim_matrix = np.empty((len(paths), first.size), dtype=np.uint8)
+    sim_matrix[0] = first.reshape(-1)
+    _build_progress(1, len(paths), progress, cancel)
+    for i, path in enumerate(paths[1:], start=1):
+        img = numpy.array(Image.open(path).convert('L'))
+        if img.size != first.size:
+            raise ValueError(f"{path} is {img.shape}, expected {first.shape} like the other simulations")
+        sim_matrix[i] = img.reshape(-1)
+        _build_progress(i + 1, len(paths), progress, cancel)
+    return sim_matrix
+
+
+# rows of the library converted to float64 at a time by every scoring thread
+SCORE_CHUNK_ROWS = 32
+
+
+# raised by score_library when the caller asks for the scan to stop
+class MatchCancelled(Exception):
+    pass
+
+
+# score the experimental image against every row of sim_matrix in one pass
+# each simulation y is fitted as a * x + b from the experimental image x using the
+# closed-form least squares slope and intercept (what curve_fit converges to),
+# and the returned value is the same MSE / 100 that get_best_image reports
+# rows are converted to float64 in chunks of chunk_size rows, copied into one buffer that is reused for every chunk,
+# so uint8 libraries are never copied whole and each call (each scoring thread) holds a single chunk of
+# SCORE_CHUNK_ROWS x 384 x 384 float64 (about 38 MB)
+# progress(done, total) is called after every chunk and setting the cancel event
+# (a threading.Event) stops the scan with MatchCancelled
+def score_library(exp_image, sim_matrix, chunk_size=None, progress=None, cancel=None):
+    chunk_size = SCORE_CHUNK_ROWS if chunk_size is None else chunk_size
+    x = np.asarray(exp_image, dtype=np.float64).reshape(-1)
+    if sim_matrix.ndim != 2 or sim_matrix.shape[1] != x.size:
+        raise ValueError(f"simulation matrix of shape {sim_matrix.shape} does not match an image of {x.size} pixels")
+
+    x_centered = x - x.mean()
+    x_ss = np.dot(x_centered, x_centered)
+
+    scores = np.empty(sim_matrix.shape[0], dtype=np.float64)
+    buffer = np.empty((min(chunk_size, sim_matrix.shape[0]), x.size), dtype=np.float64)
+    for start in range(0, sim_matrix.shape[0], chunk_size):
+        rows = sim_matrix[start:start + chunk_size]
+        chunk = buffer[:rows.shape[0]]
+        np.copyto(chunk, rows, casting='unsafe')
+        chunk -= chunk.mean(axis=1, keepdims=True)
+
+        # residual sum of squares of the fit is Syy - Sxy^2 / Sxx
+        y_ss = np.einsum('ij,ij->i', chunk, chunk)
+        if x_ss > 0:
+            xy = chunk @ x_centered
+            residual = y_ss - xy ** 2 / x_ss
+        else:
+            residual = y_ss     # flat input image, best fit is the mean of y
+        scores[start:start + chunk.shape[0]] = np.maximum(residual, 0) / x.size / 100
+
+        if progress is not None:
+            progress(start + chunk.shape[0], sim_matrix.shape[0])
+        if cancel is not None and cancel.is_set():
+            raise MatchCancelled()
+    return scores
+
+
+# number of threads used to score a library, None uses one per CPU core
+score_workers = None
+
+
+# split n_rows into contiguous (start, stop) shards, a few per worker so that uneven shards even out
+# shards are at least min_rows long so short libraries are not split into more shards than pay off, the memory
+# used per worker only depends on SCORE_CHUNK_ROWS
+def _shard_bounds(n_rows, workers, min_rows=256):
+    shard_size = max(min_rows, -(-n_rows // (workers * 4)))
+    return [(start, min(start + shard_size, n_rows)) for start in range(0, n_rows, shard_size)]
+
+
+# score every shard of sim_matrix with score_library and pass (start, scores) of each shard to reduce_shard
+# shards run on a thread pool: the NumPy products inside score_library release the GIL, and threads
+# read a memory mapped library directly instead of pickling it to worker processes
+def _score_shards(exp_image, sim_matrix, reduce_shard, workers=None, progress=None, cancel=None):
+    workers = (score_workers or os.cpu_count() or 1) if workers is None else workers
+    shards = _shard_bounds(sim_matrix.shape[0], workers)
+
+    lock = threading.Lock()
+    scored = [0] * len(shards)
+
+    def score_shard(index):
+        start, stop = shards[index]
+
+        def shard_progress(done, total):
+            with lock:
+                scored[index] = done
+                total_scored = sum(scored)
+            progress(total_scored, sim_matrix.shape[0])
+
+        scores = score_library(exp_image, sim_matrix[start:stop], progress=shard_progress if progress else None,
+                               cancel=cancel)
+        return reduce_shard(start, scores)
+
+    if workers <= 1 or len(shards) <= 1:
+        return [score_shard(index) for index in range(len(shards))]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(score_shard, range(len(shards))))
+
+
+# score_library split into shards that are scored in parallel, returns all N scores in order
+def score_library_parallel(exp_image, sim_matrix, workers=None, progress=None, cancel=None):
+    shard_scores = _score_shards(exp_image, sim_matrix, lambda start, scores: scores, workers, progress, cancel)
+    return np.concatenate(shard_scores) if shard_scores else np.empty(0)
+
+
+# indices and scores of the k best (lowest mse) simulations, best first
+# every shard keeps only its own top k and the shard results are merged at the end
+def top_k_library(exp_image, sim_matrix, k=5, workers=None, progress=None, cancel=None):
+    def shard_top_k(start, scores):
+        best = np.argpartition(scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+        return start + best, scores[best]
+
+    shard_results = _score_shards(exp_image, sim_matrix, shard_top_k, workers, progress, cancel)
+    indices = np.concatenate([result[0] for result in shard_results])
+    scores = np.concatenate([result[1] for result in shard_results])
+    order = np.argsort(scores, kind='stable')[:k]
+    return indices[order], scores[order]
+
+
+# simulation file names written by img_simulation.simImg, e.g. "17 nm.tif",
+# "20 nm_0mrad_0steps.tif" or "20 nm_10mrad_5steps_step3.tif"
+SIMULATION_NAME_PATTERN = re.compile(r'(?P<thickness>\d+(?:\.\d+)?) ?nm'
+                                     r'(?:_(?P<mistilt>\d+(?:\.\d+)?)mrad_(?P<tilt_steps>\d+)steps(?:_step(?P<step>\d+))?)?')
+
+
+# read the thickness (nm), mistilt (mrad), number of tilt steps and tilt step index from a simulation file name
+# fields that are not part of the name are returned as nan (thickness) or 0 (tilt fields)
+def parse_simulation_name(filename):
+    match = SIMULATION_NAME_PATTERN.match(os.path.basename(filename))
+    if match is None:
+        return {'thickness': np.nan, 'mistilt': 0.0, 'tilt_steps': 0, 'step': 0}
+    return {
+        'thickness': float(match.group('thickness')),
+        'mistilt': float(match.group('mistilt') or 0),
+        'tilt_steps': int(match.group('tilt_steps') or 0),
+        'step': int(match.group('step') or 0),
+    }
+
+
+# memory map one array stored inside an uncompressed .npz file (np.savez stores members without compression)
+# returns a read-only numpy.memmap, or None if the member is compressed and has to be read normally
+def _memmap_npz_array(path, name):
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+
+    with open(path, 'rb') as file:
+        # skip the zip local file header to reach the .npy header of the member
+        file.seek(info.header_offset)
+        local_header = file.read(30)
+        name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+        file.seek(info.header_offset + 30 + name_length + extra_length)
+
+        version = np.lib.format.read_magic(file)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+        offset = file.tell()
+
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran_order else 'C')
+
+
+# percentiles of the intensities mapped to black and white when a raw pattern is turned into an image,
+# the same 'ordered' intensity range py4DSTEM.visualize.show draws the simulation figures with
+PATTERN_INTENSITY_RANGE = (2, 98)
+
+
+# convert a raw simulated intensity array to a size x size 8 bit grayscale image
+def pattern_to_gray(pattern, size=PROCESSED_SIZE):
+    pattern = np.asarray(pattern, dtype=np.float64)
+    low, high = np.percentile(pattern, PATTERN_INTENSITY_RANGE)
+    if high <= low:
+        gray = np.zeros(pattern.shape, dtype=np.uint8)
+    else:
+        gray = (np.clip((pattern - low) / (high - low), 0, 1) * 255).astype(np.uint8)
+    return _resize(gray, size, size)
+
+
+# side length of the downsampled pyramid level stored with every library for coarse-to-fine searches
+PYRAMID_SIZE = 96
+
+
+# downsample a stack of flattened images (one per row) to size x size, one flattened image per row
+def downsample_images(images, image_shape, size):
+    small = np.empty((len(images), size * size), dtype=np.uint8)
+    for i in range(len(images)):
+        image = np.asarray(images[i], dtype=np.uint8).reshape(image_shape)
+        small[i] = cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA).reshape(-1)
+    return small
+
+
+# rise of the mse above its minimum that still counts as an equally good match, in the units of the scores
+# (MSE / 100 of the 8 bit images, so 0.05 is an rms difference of about 2 gray levels), sets the +- uncertainty
+# of the refined (thickness, tilt) search together with the scatter of the mse around the fitted parabola
+MSE_TOLERANCE = 0.05
+
+
+# tilt (mrad) of every simulation about the two orthogonal tilt axes of img_simulation.tiltedZoneAxes
+# step is the 1-based index into its tilt_steps x tilt_steps grid from 0 to mistilt, in meshgrid order
+# returns two arrays, both 0 for 0-tilt simulations
+def tilt_components(metadata):
+    mistilt = np.nan_to_num(np.asarray(metadata['mistilt'], dtype=np.float64))
+    tilt_steps = np.nan_to_num(np.asarray(metadata['tilt_steps'], dtype=np.float64)).astype(int)
+    step = np.nan_to_num(np.asarray(metadata['step'], dtype=np.float64)).astype(int)
+    tilted = (tilt_steps > 1) & (step > 0)
+    spacing = np.where(tilted, mistilt / np.maximum(tilt_steps - 1, 1), 0)
+    index = np.maximum(step - 1, 0)
+    return spacing * (index % np.maximum(tilt_steps, 1)), spacing * (index // np.maximum(tilt_steps, 1))
+
+
+# total tilt (mrad) of every simulation away from the zone axis
+def tilt_angles(metadata):
+    return np.hypot(*tilt_components(metadata))
+
+
+# vertex of the parabola through three points around a minimum at x[1], and the distance from the vertex at which
+# the parabola has risen by rise, returns (x[1], half the grid span) when the points do not curve upwards
+# the distance only depends on the curvature, not on the mse level of the minimum
+def _parabola_vertex(x, y, rise):
+    a, b, c = np.polyfit(np.asarray(x) - x[1], y, 2)
+    if a <= 0:
+        return x[1], (x[2] - x[0]) / 2
+    vertex = min(max(x[1] - b / (2 * a), x[0]), x[2])
+    return vertex, np.sqrt(rise / a)
+
+
+# refine the minimum of one line of the mse surface, values are the grid coordinates of the cells
+# on the line and best the position of the best cell among them
+# returns the refined coordinate and its uncertainty (grid spacing at the edge of the grid, nan without neighbours)
+# a neighbour more than twice as far as the one on the other side (a gap between the windows of a seeded search)
+# counts as the edge of the grid
+def _refine_line(values, scores, best, rise):
+    order = np.argsort(values)
+    values, scores = np.asarray(values)[order], np.asarray(scores)[order]
+    i = int(np.flatnonzero(order == best)[0])
+    if len(values) == 1:
+        return values[0], np.nan
+    if i == 0 or i == len(values) - 1:
+        return values[i], abs(values[1] - values[0]) if i == 0 else abs(values[-1] - values[-2])
+    left, right = values[i] - values[i - 1], values[i + 1] - values[i]
+    if right > 2 * left or left > 2 * right:
+        return values[i], min(left, right)
+    return _parabola_vertex(values[i - 1:i + 2], scores[i - 1:i + 2], max(rise, _parabola_noise(values, scores, i)))
+
+
+# residual variance of a least squares parabola through the cell i and up to two cells on each side of it
+# (cells more than twice the neighbour spacing away are left out), 0 with only three cells since these fit exactly
+# a noisy mse curve gets a larger rise, and so a larger uncertainty, than a smooth one with the same curvature
+def _parabola_noise(values, scores, i):
+    spacing = max(values[i] - values[i - 1], values[i + 1] - values[i])
+    window = slice(max(i - 2, 0), i + 3)
+    near = np.abs(values[window] - values[i]) <= 2 * spacing
+    x, y = values[window][near] - values[i], scores[window][near]
+    if len(x) <= 3:
+        return 0.0
+    residual = y - np.polyval(np.polyfit(x, y, 2), x)
+    return float(np.dot(residual, residual) / (len(x) - 3))
+
+
+# best (thickness, tilt) from the mse of a set of simulations, metadata holds their library metadata
+# the simulations are placed on a 2D grid of thickness (nm) x total tilt (mrad), keeping the lowest mse of every cell,
+# and the best cell is refined by a parabola through its neighbours along each axis, so off-grid results come
+# with an uncertainty: the distance at which the parabola has risen by tolerance (in score units, see MSE_TOLERANCE)
+# above its minimum, or by the residual variance of the mse around the parabola when the curve is noisier than that
+# when the best tilt has no other thickness, the thickness is refined over the lowest mse of every thickness instead
+# returns a dict with thickness, thickness_error, tilt, tilt_error (nm, mrad), mse and index of the best simulation
+def search_thickness_tilt(metadata, scores, tolerance=MSE_TOLERANCE):
+    scores = np.asarray(scores, dtype=np.float64)
+    thickness = np.asarray(metadata['thickness'], dtype=np.float64)
+    tilt = np.round(tilt_angles(metadata), 6)
+    valid = np.flatnonzero(~np.isnan(thickness))
+    if not len(valid):
+        raise ValueError("None of the simulations has a known thickness")
+
+    # lowest mse of every (thickness, tilt) cell
+    cells = {}
+    for i in valid:
+        key = (thickness[i], tilt[i])
+        if key not in cells or scores[i] < scores[cells[key]]:
+            cells[key] = i
+    best_thickness, best_tilt = min(cells, key=lambda key: scores[cells[key]])
+    best_index = cells[(best_thickness, best_tilt)]
+    rise = tolerance
+
+    line = [key for key in cells if key[1] == best_tilt]
+    if len(line) > 1:
+        refined_thickness, thickness_error = _refine_line([key[0] for key in line], [scores[cells[key]] for key in line],
+                                                          line.index((best_thickness, best_tilt)), rise)
+    else:
+        # the best tilt is only simulated at this thickness (tilt grids exist at a few thicknesses), so refine over the
+        # lowest mse of every thickness over all tilts instead, with at least the thickness grid spacing as uncertainty
+        curve_thickness, curve = mse_curve(thickness[valid], scores[valid])
+        best = int(np.flatnonzero(curve_thickness == best_thickness)[0])
+        refined_thickness, thickness_error = _refine_line(curve_thickness, curve, best, rise)
+        spacing = np.diff(curve_thickness)[max(best - 1, 0):best + 1]
+        if len(spacing):
+            thickness_error = max(thickness_error, spacing.min())
+    line = [key for key in cells if key[0] == best_thickness]
+    refined_tilt, tilt_error = _refine_line([key[1] for key in line], [scores[cells[key]] for key in line],
+                                            line.index((best_thickness, best_tilt)), rise)
+    return {'thickness': float(refined_thickness), 'thickness_error': float(thickness_error),
+            'tilt': float(refined_tilt), 'tilt_error': float(tilt_error),
+            'mse': float(scores[best_index]), 'index': int(best_index)}
+
+
+# thicknesses (nm) closer than this to the best match count as the same minimum of the mse curve
+CONFIDENCE_WINDOW = 5
+
+
+# mse-vs-thickness curve of a set of simulations: the sorted thicknesses and the lowest mse at each of them
+# (over all tilts), simulations without a known thickness are left out
+def mse_curve(thickness, scores):
+    thickness = np.asarray(thickness, dtype=np.float64)
+    scores = np.asarray(scores, dtype=np.float64)
+    valid = ~np.isnan(thickness)
+    thicknesses, groups = np.unique(thickness[valid], return_inverse=True)
+    curve = np.full(len(thicknesses), np.inf)
+    np.minimum.at(curve, groups, scores[valid])
+    return thicknesses, curve
+
+
+# how clearly the curve picks its minimum: 1 - best mse / lowest mse farther than window nm from the best thickness
+# near 1 for a single sharp minimum, near 0 when another thickness fits almost as well, nan without such thicknesses
+def curve_confidence(thicknesses, curve, best_thickness, window=CONFIDENCE_WINDOW):
+    outside = np.abs(thicknesses - best_thickness) > window
+    if not outside.any():
+        return np.nan
+    best, rival = np.min(curve), np.min(curve[outside])
+    return float(1 - best / rival) if rival > 0 else 0.0
+
+
+# everything a match of one experimental image produced, computed once from the scores of a scoring pass:
+#   thickness, thickness_error, tilt, tilt_error   refined best match and uncertainties (see search_thickness_tilt)
+#   mse, index, file                               mse, library index and file name of the best simulation
+#   matches                                        table of the k best simulations (file, thickness, tilt, mse, index)
+#   curve_thickness, curve_mse                     mse-vs-thickness curve (lowest mse over all tilts per thickness)
+#   confidence                                     sharpness of the curve minimum (see curve_confidence)
+class MatchResult:
+    def __init__(self, refined, matches, curve_thickness, curve_mse, confidence, file, image=None):
+        self.thickness = refined['thickness']
+        self.thickness_error = refined['thickness_error']
+        self.tilt = refined['tilt']
+        self.tilt_error = refined['tilt_error']
+        self.mse = refined['mse']
+        self.index = refined['index']
+        self.file = file
+        self.matches = matches
+        self.curve_thickness = curve_thickness
+        self.curve_mse = curve_mse
+        self.confidence = confidence
+        self.image = image          # the best fit simulation as the library holds it, 8 bit grayscale
+
+    # result from the mse of the library simulations at indices, e.g. a full scan or the candidates of a search
+    @classmethod
+    def from_scores(cls, library, indices, scores, k=5, tolerance=MSE_TOLERANCE):
+        indices = np.asarray(indices)
+        scores = np.asarray(scores, dtype=np.float64)
+        refined = library.search(indices, scores, tolerance)
+
+        thickness = library.metadata['thickness'][indices].astype(np.float64)
+        order = np.argsort(scores, kind='stable')[:k]
+        matches = pd.DataFrame({'file': library.files[indices[order]], 'thickness': thickness[order],
+                                'tilt': tilt_angles({field: values[indices[order]] for field, values in library.metadata.items()}),
+                                'mse': scores[order], 'index': indices[order]})
+
+        curve_thickness, curve_mse = mse_curve(thickness, scores)
+        confidence = curve_confidence(curve_thickness, curve_mse, library.metadata['thickness'][refined['index']])
+        image = np.array(library.images[refined['index']]).reshape(library.image_shape)
+        return cls(refined, matches, curve_thickness, curve_mse, confidence, str(library.files[refined['index']]), image)
+
+    # path of the best fit simulation image in the simulation directory, None when there is no such file:
+    # libraries built from a pattern store only have the raw arrays (shown from image instead)
+    def best_fit_path(self, directory):
+        path = os.path.join(directory, self.file)
+        return path if os.path.isfile(path) else None
+
+    # the scalar results as one flat dict, e.g. a row of a results table
+    def summary(self):
+        return {'thickness_nm': self.thickness, 'error_nm': self.thickness_error, 'tilt_mrad': self.tilt,
+                'tilt_error_mrad': self.tilt_error, 'confidence': self.confidence, 'best_fit_file': self.file,
+                'mse': self.mse}
+
+    # everything as plain lists and numbers, e.g. for a JSON report
+    def to_dict(self):
+        result = self.summary()
+        result['top_matches'] = self.matches.to_dict(orient='records')
+        result['mse_curve'] = {'thickness_nm': self.curve_thickness.tolist(), 'mse': self.curve_mse.tolist()}
+        return result
+
+
+# trained CNN used by cnn_estimate, None for the default model of cnn_predictions
+# the heavier dependencies are imported on first use so that importing this module (and opening the GUI) stays fast:
+# matplotlib for decoding experimental images, scipy for the feature index and tensorflow for the CNN
+# preload() imports them ahead of time, e.g. on a background thread while the GUI waits for the user
+def preload(cnn=False):
+    with timing.stage('preload', cnn=cnn):
+        import matplotlib.image
+        import scipy.spatial
+        if cnn:
+            cnn_predictor()
+
+
+cnn_model_path = None
+CNN_TOP_K = 3           # CNN thicknesses that seed the mse search
+CNN_WINDOW = 2          # nm around each of them whose simulations are scored
+
+_predictor = None
+_predictor_lock = threading.Lock()
+
+
+# the CNN thickness predictor, loaded the first time it is needed and then kept for the session
+# tensorflow is only imported here, so the mse matching works without it
+def cnn_predictor():
+    global _predictor
+    with _predictor_lock:
+        import cnn_predictions
+        model_path = cnn_predictions.MODEL_PATH if cnn_model_path is None else cnn_model_path
+        if _predictor is None or _predictor.modelPath != model_path:
+            _predictor = cnn_predictions.ThicknessPredictor(model_path)
+        return _predictor
+
+
+# CNN thickness estimate of a processed experimental image (the output of pre_process_array / pre_process_file)
+# returns a dict with the predicted thickness (nm), its probability (confidence) and the top_k thicknesses
+# and their probabilities, best first
+def cnn_estimate(processed_image, top_k=CNN_TOP_K):
+    with timing.stage('cnn_estimate'):
+        row = cnn_predictor().predictArrays([processed_image], topK=top_k).iloc[0]
+    return {'thickness': float(row['predicted_class']), 'confidence': float(row['confidence']),
+            'top_thicknesses': [float(t) for t in row['top_classes']],
+            'top_probabilities': [float(p) for p in row['top_probabilities']]}
+
+
+# name of the preloaded library file written next to the simulations
+LIBRARY_FILENAME = 'simulation_library.npz'
+
+# simulation parameters given for a library (voltage, zone axis, convergence angle), kept in a small file of their
+# own next to the library so that recording them never rewrites the library file with its images
+LIBRARY_PARAMS_FILENAME = 'simulation_library_params.json'
+
+
+# the simulation parameters recorded for the library of a directory, {} when none were recorded
+def read_library_params(directory):
+    try:
+        with open(os.path.join(directory, LIBRARY_PARAMS_FILENAME)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+# the given simulation parameters that are set (not nan or ''), in the form they are recorded in
+def library_params(voltage=np.nan, zone_axis='', convergence_angle=np.nan):
+    params = {}
+    if not np.isnan(float(voltage)):
+        params['voltage'] = float(voltage)
+    if zone_axis:
+        params['zone_axis'] = str(zone_axis)
+    if not np.isnan(float(convergence_angle)):
+        params['convergence_angle'] = float(convergence_angle)
+    return params
+
+
+# a directory of simulation images decoded once into a single grayscale array
+# images holds one flattened uint8 simulation per row and metadata holds one column per field
+class SimulationLibrary:
+    METADATA_FIELDS = ('thickness', 'mistilt', 'tilt_steps', 'step', 'voltage', 'zone_axis', 'convergence_angle')
+
+    def __init__(self, images, image_shape, files, metadata, mtimes=None, pyramids=None):
+        self.images = images
+        self.image_shape = tuple(image_shape)
+        self.files = np.asarray(files, dtype=str)
+        self.metadata = {field: np.asarray(metadata[field]) for field in self.METADATA_FIELDS}
+        self.mtimes = np.zeros(len(self.files)) if mtimes is None else np.asarray(mtimes, dtype=np.float64)
+        # downsampled copies of the images keyed by side length
+        self.pyramids = {} if pyramids is None else dict(pyramids)
+
+    def __len__(self):
+        return len(self.files)
+
+    # decode every simulation image in a directory
+    # voltage (kV), zone axis and convergence angle (mrad) are not part of the file names so they are recorded as given
+    @classmethod
+    def from_directory(cls, directory, voltage=np.nan, zone_axis='', convergence_angle=np.nan, progress=None, cancel=None):
+        paths = list_simulations(directory)
+        if not paths:
+            raise ValueError(f"No simulation images were found in {directory}")
+
+        images = stack_simulations(paths, progress, cancel)
+        image_shape = numpy.array(Image.open(paths[0]).convert('L')).shape
+        parsed = [parse_simulation_name(path) for path in paths]
+        metadata = {field: [p[field] for p in parsed] for field in ('thickness', 'mistilt', 'tilt_steps', 'step')}
+        metadata['voltage'] = np.full(len(paths), float(voltage))
+        metadata['zone_axis'] = np.full(len(paths), str(zone_axis))
+        metadata['convergence_angle'] = np.full(len(paths), float(convergence_angle))
+        mtimes = [os.path.getmtime(path) for path in paths]
+        library = cls(images, image_shape, [os.path.basename(path) for path in paths], metadata, mtimes)
+        library.pyramid(PYRAMID_SIZE)   # built now so it is saved with the library
+        return library
+
+    # build the library straight from the raw intensity arrays of a PatternStore written by img_simulation.py
+    # the simulation parameters come from the store, no image files are decoded
+    # start skips the first patterns of the store, used to convert only the patterns added since the last build
+    @classmethod
+    def from_store(cls, directory, size=PROCESSED_SIZE, start=0, progress=None, cancel=None):
+        store = PatternStore(directory)
+        if len(store) <= start:
+            raise ValueError(f"No simulated patterns were found in {directory}")
+
+        images = np.empty((len(store) - start, size * size), dtype=np.uint8)
+        rows = []
+        for i, (row, pattern) in enumerate(store.iterate(start)):
+            images[i] = pattern_to_gray(pattern, size).reshape(-1)
+            rows.append(row)
+            _build_progress(i + 1, len(images), progress, cancel)
+
+        def column(field, default):
+            return [default if row[field] == '' else row[field] for row in rows]
+
+        metadata = {field: np.asarray(column(field, np.nan), dtype=np.float64)
+                    for field in ('thickness', 'mistilt', 'tilt_steps', 'step', 'voltage', 'convergence_angle')}
+        metadata['zone_axis'] = np.asarray(column('zone_axis', ''), dtype=str)
+        library = cls(images, (size, size), [row['name'] for row in rows], metadata)
+        library.pyramid(PYRAMID_SIZE)
+        return library
+
+    # append the simulations of another library with the same image size
+    # the pyramid levels of this library are extended so they stay in step with the images
+    def extend(self, other):
+        if tuple(other.image_shape) != self.image_shape:
+            raise ValueError(f"Cannot add {other.image_shape} simulations to a library of {self.image_shape} simulations")
+        for size, small in self.pyramids.items():
+            self.pyramids[size] = np.concatenate([small, other.pyramid(size)])
+        self.images = np.concatenate([self.images, other.images])
+        self.files = np.concatenate([self.files, other.files])
+        self.metadata = {field: np.concatenate([self.metadata[field], other.metadata[field]])
+                         for field in self.METADATA_FIELDS}
+        self.mtimes = np.concatenate([self.mtimes, other.mtimes])
+
+    # write the library as a single uncompressed .npz file
+    # the file is written next to the target and then swapped in (atomic_write) so processes that
+    # still have the old library memory mapped keep reading a consistent copy
+    def save(self, path):
+        arrays = {'meta_' + field: values for field, values in self.metadata.items()}
+        arrays.update({f'pyramid_{size}': small for size, small in self.pyramids.items()})
+        with atomic_write(path) as file:
+            np.savez(file, images=self.images, image_shape=np.array(self.image_shape), files=self.files,
+                     mtimes=self.mtimes, **arrays)
+
+    # load a saved library, by default memory mapping the images read-only so that every
+    # process opening the same file shares one copy through the OS page cache
+    @classmethod
+    def load(cls, path, mmap=True):
+        def read(data, name):
+            array = _memmap_npz_array(path, name) if mmap else None
+            return data[name] if array is None else array
+
+        with np.load(path) as data:
+            metadata = {field: data['meta_' + field] for field in cls.METADATA_FIELDS}
+            pyramids = {int(name[len('pyramid_'):]): read(data, name) for name in data.files if name.startswith('pyramid_')}
+            return cls(read(data, 'images'), data['image_shape'], data['files'], metadata, data['mtimes'], pyramids)
+
+    # open the preloaded library for a simulation directory, decoding the images only when
+    # the library file is missing or the directory contents have changed since it was written
+    # a directory holding a PatternStore and no simulation images is built from the store instead, and
+    # patterns added to the store since the library was written are converted and appended to it
+    # the voltage, zone axis and convergence angle are recorded in the LIBRARY_PARAMS_FILENAME file, values
+    # that differ from the recorded ones replace them there without rewriting the library file
+    # progress(done, total) is called while simulations are decoded and setting the cancel event stops the
+    # build with MatchCancelled, like score_library
+    @classmethod
+    def open(cls, directory, voltage=np.nan, zone_axis='', convergence_angle=np.nan, mmap=True, progress=None, cancel=None):
+        with timing.stage('library_open', directory=directory):
+            return cls._open(directory, voltage, zone_axis, convergence_angle, mmap, progress, cancel)
+
+    @classmethod
+    def _open(cls, directory, voltage, zone_axis, convergence_angle, mmap, progress=None, cancel=None):
+        library_path = os.path.join(directory, LIBRARY_FILENAME)
+        paths = list_simulations(directory)
+        from_store = not paths and os.path.exists(os.path.join(directory, STORE_METADATA_FILENAME))
+        if from_store:
+            files = PatternStore(directory).names()
+            mtimes = np.zeros(len(files))
+        else:
+            files, mtimes = [os.path.basename(path) for path in paths], [os.path.getmtime(path) for path in paths]
+        library = None
+        up_to_date = False
+        if os.path.exists(library_path):
+            with np.load(library_path) as data:
+                up_to_date = list(data['files']) == files and np.array_equal(data['mtimes'], mtimes)
+                grown = from_store and len(data['files']) < len(files) and list(data['files']) == files[:len(data['files'])]
+            if up_to_date:
+                library = cls.load(library_path, mmap)
+            elif grown:
+                library = cls.load(library_path, mmap=False)
+                library.extend(cls.from_store(directory, library.image_shape[0], len(library), progress, cancel))
+
+        rebuilt = not up_to_date
+        if library is None:
+            with timing.stage('library_build', directory=directory):
+                if from_store:
+                    library = cls.from_store(directory, progress=progress, cancel=cancel)
+                else:
+                    library = cls.from_directory(directory, progress=progress, cancel=cancel)
+        if rebuilt:
+            try:
+                with timing.stage('library_save', path=library_path):
+                    library.save(library_path)
+            except OSError:
+                pass    # read-only simulation folder, the library is simply rebuilt next time
+
+        recorded = read_library_params(directory)
+        params = dict(recorded, **library_params(voltage, zone_axis, convergence_angle))
+        library.describe(**params)
+        if params != recorded:
+            try:
+                with atomic_write(os.path.join(directory, LIBRARY_PARAMS_FILENAME), 'w') as file:
+                    json.dump(params, file, indent=2)
+            except OSError:
+                pass
+        return library
+
+    # set the simulation parameters that cannot be read from the file names, in memory (open records them on disk)
+    # values left as nan or '' are not changed, returns True if anything changed
+    def describe(self, voltage=np.nan, zone_axis='', convergence_angle=np.nan):
+        changed = False
+        for field, value in (('voltage', voltage), ('zone_axis', zone_axis), ('convergence_angle', convergence_angle)):
+            if field == 'zone_axis':
+                if not zone_axis:
+                    continue
+                column = np.full(len(self), str(value))
+            else:
+                value = float(value)
+                if np.isnan(value):
+                    continue
+                column = np.full(len(self), value)
+            if not np.array_equal(column, self.metadata[field]):
+                self.metadata[field] = column
+                changed = True
+        return changed
+
+    # refined (thickness, tilt) match from the mse of the simulations at indices (see search_thickness_tilt)
+    # the index of the returned best simulation is an index into the library
+    def search(self, indices, scores, tolerance=MSE_TOLERANCE):
+        indices = np.asarray(indices)
+        result = search_thickness_tilt({field: values[indices] for field, values in self.metadata.items()}, scores, tolerance)
+        result['index'] = int(indices[result['index']])
+        return result
+
+    # structured result of a scoring pass over the simulations at indices, with the k best matches
+    def match_result(self, indices, scores, k=5, tolerance=MSE_TOLERANCE):
+        with timing.stage('match_result', candidates=len(indices)):
+            return MatchResult.from_scores(self, indices, scores, k, tolerance)
+
+    # full paths of the simulation files
+    def paths(self, directory):
+        return [os.path.join(directory, name) for name in self.files]
+
+    # metadata as a table with one row per simulation
+    def table(self):
+        table = pd.DataFrame(self.metadata)
+        table.insert(0, 'file', self.files)
+        return table
+
+    # mse of every simulation in the library against a processed experimental image
+    # scored in parallel shards on `workers` threads (score_workers by default)
+    def score(self, exp_image, workers=None, progress=None, cancel=None):
+        with timing.stage('score', simulations=len(self)):
+            return score_library_parallel(exp_image, self.images, workers, progress, cancel)
+
+    # indices of the simulations within window nm of any of the given thicknesses
+    def near_thickness(self, thicknesses, window=CNN_WINDOW):
+        distance = np.abs(self.metadata['thickness'][:, None] - np.asarray(thicknesses, dtype=np.float64)[None, :])
+        return np.flatnonzero((distance <= window).any(axis=1))
+
+    # score only the simulations near the given thicknesses (e.g. the CNN's top thicknesses)
+    # returns the indices of the scored simulations and their mse
+    def score_near(self, exp_image, thicknesses, window=CNN_WINDOW, workers=None, progress=None, cancel=None):
+        indices = self.near_thickness(thicknesses, window)
+        if not len(indices):
+            raise ValueError(f"No simulations within {window:g} nm of {', '.join(f'{t:g}' for t in thicknesses)} nm")
+        with timing.stage('score', simulations=len(indices)):
+            return indices, score_library_parallel(exp_image, self.images[indices], workers, progress, cancel)
+
+    # indices and mse of the k best matching simulations, best first
+    def top_k(self, exp_image, k=5, workers=None, progress=None, cancel=None):
+        return top_k_library(exp_image, self.images, k, workers, progress, cancel)
+
+    # the images downsampled to size x size, computed once and kept with the library
+    def pyramid(self, size):
+        if size not in self.pyramids:
+            self.pyramids[size] = downsample_images(self.images, self.image_shape, size)
+        return self.pyramids[size]
+
+    # coarse-to-fine search: every simulation is scored on the size x size pyramid level and only the
+    # k best coarse candidates are re-scored at full resolution
+    # candidates whose coarse mse is within `tolerance` (relative) of the k-th best coarse mse are
+    # re-scored as well, so raising the tolerance trades speed for agreement with the brute force scan
+    # returns indices and full resolution mse of the candidates, best first
+    def coarse_to_fine(self, exp_image, k=16, size=PYRAMID_SIZE, tolerance=0.0, workers=None, cancel=None):
+        exp_image = np.asarray(exp_image, dtype=np.uint8).reshape(self.image_shape)
+        exp_small = cv2.resize(exp_image, (size, size), interpolation=cv2.INTER_AREA)
+        coarse = score_library_parallel(exp_small, self.pyramid(size), workers, cancel=cancel)
+
+        k = min(k, len(coarse))
+        kth_best = np.partition(coarse, k - 1)[k - 1]
+        candidates = np.flatnonzero(coarse <= kth_best * (1 + tolerance))
+
+        fine = score_library(exp_image, self.images[candidates], cancel=cancel)
+        order = np.argsort(fine, kind='stable')
+        return candidates[order], fine[order]
+
+
+# each row shifted to zero mean and scaled to unit length, so the distance between two rows is
+# sqrt(2 - 2 * correlation) and small distances mean a good linear fit
+def _standardize(rows):
+    rows = np.array(rows, dtype=np.float64)
+    rows -= rows.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(rows, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return rows / norms
+
+
+# azimuthal average of every flattened size x size image (one per row) around the image center
+def radial_profiles(images, size):
+    y, x = np.indices((size, size))
+    radius = np.hypot(x - size // 2, y - size // 2).astype(int).reshape(-1)
+    counts = np.bincount(radius)
+    return np.array([np.bincount(radius, weights=np.asarray(row, dtype=np.float64)) / counts for row in images])
+
+
+# embeddings of flattened size x size images (one per row) for FeatureIndex, computed in chunks
+def _embed(images, method, size, mean=None, basis=None, chunk_size=1024):
+    embedded = []
+    for start in range(0, len(images), chunk_size):
+        rows = images[start:start + chunk_size]
+        if method == 'radial':
+            embedded.append(_standardize(radial_profiles(rows, size)))
+        else:
+            embedded.append((_standardize(rows) - mean) @ basis.T)
+    return np.concatenate(embedded)
+
+
+# name of the feature index file written next to the simulations, per embedding method
+INDEX_FILENAME = 'simulation_index_{}.npz'
+
+
+# k-d tree over a set of points, scipy is imported the first time one is built
+def kd_tree(points):
+    from scipy.spatial import cKDTree
+    return cKDTree(points)
+
+
+# low dimensional embeddings of every simulation in a library with a KD-tree over them, used to
+# find nearest simulation candidates without scoring the whole library
+# the embeddings are taken from the PYRAMID_SIZE pyramid level and are either a PCA projection
+# ('pca') or the azimuthally averaged radial profile ('radial') of the standardized pattern
+class FeatureIndex:
+    def __init__(self, method, size, embeddings, files, mean=None, basis=None, mtimes=None):
+        self.method = str(method)
+        self.size = int(size)
+        self.embeddings = np.asarray(embeddings)
+        self.files = np.asarray(files, dtype=str)
+        # modification times of the library simulations the embeddings were computed from, nan when unknown
+        self.mtimes = np.full(len(self.files), np.nan) if mtimes is None else np.asarray(mtimes, dtype=np.float64)
+        self.mean = mean
+        self.basis = basis
+        self.tree = kd_tree(self.embeddings)
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    # embeddings of flattened size x size images, one per row
+    def embed(self, images):
+        return _embed(images, self.method, self.size, self.mean, self.basis)
+
+    # build the index for a library, the PCA basis is fitted on at most `sample` evenly spaced simulations
+    @classmethod
+    def build(cls, library, method='pca', components=32, size=PYRAMID_SIZE, sample=2000):
+        if method not in ('pca', 'radial'):
+            raise ValueError(f"Unknown embedding method {method!r}, expected 'pca' or 'radial'")
+        small = library.pyramid(size)
+
+        mean = basis = None
+        if method == 'pca':
+            rows = _standardize(small[np.linspace(0, len(small) - 1, min(sample, len(small))).astype(int)])
+            mean = rows.mean(axis=0)
+            _, _, vt = np.linalg.svd(rows - mean, full_matrices=False)
+            basis = vt[:components]
+
+        return cls(method, size, _embed(small, method, size, mean, basis), library.files, mean, basis, library.mtimes)
+
+    # add the simulations appended to the library since the index was built, projected onto the
+    # existing PCA basis so the embeddings already in the index stay valid
+    def extend(self, library):
+        small = library.pyramid(self.size)[len(self):]
+        self.embeddings = np.concatenate([self.embeddings, self.embed(small)])
+        self.files = np.asarray(library.files, dtype=str)
+        self.mtimes = np.asarray(library.mtimes, dtype=np.float64)
+        self.tree = kd_tree(self.embeddings)
+
+    # whether the first n simulations of the library are the ones the index was built from: same names and
+    # modification times, so a simulation regenerated under the same name makes the index stale
+    def matches(self, library, n):
+        return (np.array_equal(self.files[:n], library.files[:n])
+                and np.array_equal(self.mtimes[:n], np.asarray(library.mtimes[:n], dtype=np.float64)))
+
+    def save(self, path):
+        arrays = {} if self.method == 'radial' else {'mean': self.mean, 'basis': self.basis}
+        with atomic_write(path) as file:
+            np.savez(file, method=self.method, size=self.size, embeddings=self.embeddings, files=self.files,
+                     mtimes=self.mtimes, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            mean = data['mean'] if 'mean' in data.files else None
+            basis = data['basis'] if 'basis' in data.files else None
+            mtimes = data['mtimes'] if 'mtimes' in data.files else None     # indexes saved without them are rebuilt
+            return cls(data['method'], data['size'], data['embeddings'], data['files'], mean, basis, mtimes)
+
+    # open the saved index of a simulation directory, rebuilding it when the library has changed (a simulation
+    # added, removed, renamed or regenerated), simulations appended to the end of the library are added to the
+    # saved index instead
+    @classmethod
+    def open(cls, directory, library, method='pca'):
+        index_path = os.path.join(directory, INDEX_FILENAME.format(method))
+        if os.path.exists(index_path):
+            index = cls.load(index_path)
+            if len(index) == len(library) and index.matches(library, len(library)):
+                return index
+            if len(index) < len(library) and index.matches(library, len(index)):
+                index.extend(library)
+            else:
+                index = cls.build(library, method)
+        else:
+            index = cls.build(library, method)
+        try:
+            index.save(index_path)
+        except OSError:
+            pass    # read-only simulation folder, the index is simply rebuilt next time
+        return index
+
+    # indices of the k simulations nearest to a processed experimental image in embedding space
+    def query(self, exp_image, k=32):
+        exp_image = np.asarray(exp_image, dtype=np.uint8)
+        exp_small = cv2.resize(exp_image, (self.size, self.size), interpolation=cv2.INTER_AREA)
+        _, indices = self.tree.query(self.embed(exp_small.reshape(1, -1))[0], k=min(k, len(self)))
+        return np.atleast_1d(indices)
+
+    # nearest simulation candidates verified with the full resolution linear-fit mse of get_best_image
+    # returns indices and mse of the candidates, best first
+    def match(self, library, exp_image, k=32):
+        candidates = np.sort(self.query(exp_image, k))
+        scores = score_library(exp_image, library.images[candidates])
+        order = np.argsort(scores, kind='stable')
+        return candidates[order], scores[order]
@@ -0,0 +1,114 @@
+# Batch TEM Sample Thickness Determination
+# Command line counterpart of the "Determine Thickness" button in gui.py: preprocesses every experimental
+# image in a folder (or glob) and matches it against one simulation library that is loaded only once.
+#
+# Example:
+#     python batch_thickness.py "shift_42/*.tif" --simulations sims_200kV --output shift_42.csv
+
+# imports
+import argparse
+import glob
+import os
+import sys
+
+import numpy as np
+import pandas as pd                                     # for the CSV / JSON results table
+
+import Database
+import timing
+
+EXPERIMENTAL_EXTENSIONS = ('.tif', '.tiff')
+
+
+# expand the command line inputs (directories, globs or files) into a sorted list of experimental images
+def find_images(inputs):
+    paths = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            paths.extend(os.path.join(pattern, name) for name in os.listdir(pattern)
+                         if name.lower().endswith(EXPERIMENTAL_EXTENSIONS))
+        else:
+            paths.extend(glob.glob(pattern))
+    return sorted(set(paths))
+
+
+# the simulations to compare against and their mse for one processed image
+# 'brute' scores the whole library, 'coarse' uses the coarse-to-fine search, 'index' the feature index and
+# 'cnn' only the simulations near the top thicknesses predicted by the CNN
+def match(processed_image, library, search='brute', index=None, k=16, workers=None):
+    if search == 'coarse':
+        return library.coarse_to_fine(processed_image, k=k, workers=workers)
+    if search == 'index':
+        return index.match(library, processed_image, k=k)
+    if search == 'cnn':
+        return library.score_near(processed_image, Database.cnn_estimate(processed_image)['top_thicknesses'],
+                                  workers=workers)
+    return np.arange(len(library)), library.score(processed_image, workers)
+
+
+# preprocess one experimental image and match it against the library
+# returns one row of the results table, thickness and tilt refined between the simulation grid points
+# with details the row also holds the top matches and the mse-vs-thickness curve (for JSON output)
+def determine_thickness(filePath, library, directory, search='brute', index=None, k=16, workers=None, details=False):
+    processed_image = Database.pre_process_file(filePath)
+
+    indices, scores = match(processed_image, library, search, index, k, workers)
+    result = library.match_result(indices, scores)
+    row = result.to_dict() if details else result.summary()
+    # patterns of a pattern store have no image file, their name is always recorded and the file only when it exists
+    row['best_fit_file'] = result.best_fit_path(directory) or ''
+    row['best_fit_pattern'] = result.file
+    return {'image': filePath, **row}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Determine the TEM sample thickness of a batch of experimental PACBED images.")
+    parser.add_argument('images', nargs='+', help="experimental images: directories, globs or files")
+    parser.add_argument('--simulations', required=True, help="directory with the simulation library")
+    parser.add_argument('--output', help="results file, .csv or .json (CSV on standard output if omitted)")
+    parser.add_argument('--search', choices=('brute', 'coarse', 'index', 'cnn'), default='brute',
+                        help="brute force scan, coarse-to-fine search, feature index lookup or CNN seeded scan (default: brute)")
+    parser.add_argument('--candidates', type=int, default=16, help="candidates re-scored by the coarse and index searches")
+    parser.add_argument('--workers', type=int, help="threads used to score the library (default: one per core)")
+    parser.add_argument('--voltage', type=float, default=np.nan, help="accelerating voltage in kV, recorded with the library")
+    parser.add_argument('--zone-axis', default='', help="zone axis, recorded with the library")
+    parser.add_argument('--angle', type=float, default=np.nan, help="convergence angle in mrad, recorded with the library")
+    parser.add_argument('--timing', default=os.environ.get(timing.TIMING_ENV),
+                        help="append per-stage timing records (JSON lines) to this file, '-' for standard error")
+    parser.add_argument('--profile', default=os.environ.get(timing.PROFILE_ENV),
+                        help="write a cProfile dump of every image to this directory")
+    args = parser.parse_args(argv)
+    timing.configure(args.timing, args.profile)
+
+    paths = find_images(args.images)
+    if not paths:
+        parser.error("no experimental images found")
+
+    # load the library (and index) once for the whole batch
+    library = Database.SimulationLibrary.open(args.simulations, args.voltage, args.zone_axis, args.angle)
+    index = Database.FeatureIndex.open(args.simulations, library) if args.search == 'index' else None
+
+    # the top matches and mse curves only fit in a JSON report
+    details = args.output is not None and args.output.lower().endswith('.json')
+    rows = []
+    for filePath in paths:
+        try:
+            with timing.run('thickness_determination', image=filePath):
+                rows.append(determine_thickness(filePath, library, args.simulations, args.search, index,
+                                                args.candidates, args.workers, details))
+        except Exception as error:     # one unreadable image should not stop the batch
+            print(f"{filePath}: {error}", file=sys.stderr)
+            rows.append({'image': filePath, 'error_message': str(error)})
+
+    results = pd.DataFrame(rows)
+    if args.output is None:
+        results.to_csv(sys.stdout, index=False)
+    elif args.output.lower().endswith('.json'):
+        results.to_json(args.output, orient='records', indent=2)
+    else:
+        results.to_csv(args.output, index=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,312 @@
+# Preprocessing and Matching Benchmark
+# Times the hot paths of the thickness determination on synthetic PACBED-like disks generated locally, so the
+# numbers can be reproduced on any machine without the simulation library or experimental data:
+#   preprocessing   per-stage latency of render, center, blow-up, crop and rotate (Database.pre_process_array)
+#   matching        brute force scan, top-k, coarse-to-fine and feature index search for each library size,
+#                   reported as simulations scored per second, plus the peak memory of each stage, the parallel
+#                   scan is run with 1, 4 and 8 threads to show how its memory grows with the worker count
+#   legacy          the one-file-at-a-time loop the GUI used to run, on 120 files: the original get_best_image
+#                   (scipy curve_fit per simulation) as the before number, and today's Database.get_best_image
+#                   (the closed-form fit, still one decoded file at a time) to separate the fit from the file I/O
+#   startup         time to import Database and the modules the GUI imports before its window is drawn, each in a
+#                   fresh interpreter, and the heavy modules they pull in, plus the time until the GUI window is
+#                   drawn (and the modules loaded by then) when a display is available
+# Results are written as JSON so runs before and after a change can be compared.
+#
+# Example:
+#     python benchmark.py --sizes 120 1200 12000 --output benchmark_results.json
+#     python benchmark.py --startup       only the startup check, fails if a heavy module is imported at startup
+
+# imports
+import argparse
+import ast
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import Database
+
+try:
+    import resource                                     # peak resident memory, not available on Windows
+except ImportError:
+    resource = None
+
+DEFAULT_SIZES = (120, 1200, 12000)
+WORKER_COUNTS = (1, 4, 8)           # threads the parallel scan is measured with, besides --workers
+
+# modules that must only be imported on first use, neither Database nor the GUI before its window is drawn may load them
+HEAVY_MODULES = ('py4DSTEM', 'tensorflow', 'scipy.optimize', 'scipy.spatial', 'matplotlib')
+STARTUP_SCRIPT = ("import json, sys, time\nstart = time.perf_counter()\n{imports}\n"
+                  "print(json.dumps({{'seconds': time.perf_counter() - start, 'modules': sorted(sys.modules)}}))")
+EXPERIMENT_SHAPE = (480, 640)       # height, width of the synthetic experimental images
+
+
+# a PACBED-like pattern: a bright central disk whose rim and inner rings change with thickness (0-1), drawn
+# slightly elliptical and rotated, on a dark background with noise
+def synthetic_pattern(rng, shape, thickness, center=None, radius=None):
+    height, width = shape
+    center = (width / 2, height / 2) if center is None else center
+    radius = min(shape) / 4 if radius is None else radius
+    y, x = np.indices(shape, dtype=np.float64)
+
+    angle = rng.uniform(0, np.pi)
+    dx, dy = x - center[0], y - center[1]
+    u = (dx * np.cos(angle) + dy * np.sin(angle)) / 1.05
+    v = -dx * np.sin(angle) + dy * np.cos(angle)
+    r = np.hypot(u, v) / radius
+
+    rings = 0.5 + 0.5 * np.cos(2 * np.pi * r * (2 + 6 * thickness))
+    disk = np.where(r < 1, 0.6 + 0.4 * rings * r, 0.05 * np.exp(-(r - 1) * 4))
+    return disk + rng.normal(0, 0.02, shape)
+
+
+# an experimental-like image: the disk off center, as the microscope records it
+def synthetic_experiment(rng, thickness=0.5):
+    height, width = EXPERIMENT_SHAPE
+    center = (width / 2 + rng.uniform(-40, 40), height / 2 + rng.uniform(-30, 30))
+    return synthetic_pattern(rng, EXPERIMENT_SHAPE, thickness, center, height / 5)
+
+
+# a library of size synthetic simulations written to a memory mapped file in directory, one flattened
+# PROCESSED_SIZE x PROCESSED_SIZE uint8 image per row, thicknesses evenly spaced from 0 to 1
+def synthetic_library(rng, size, directory):
+    side = Database.PROCESSED_SIZE
+    images = np.lib.format.open_memmap(os.path.join(directory, f'library_{size}.npy'), mode='w+', dtype=np.uint8,
+                                       shape=(size, side * side))
+    metadata = {'thickness': np.linspace(1, 120, size), 'mistilt': np.zeros(size), 'tilt_steps': np.zeros(size),
+                'step': np.zeros(size), 'voltage': np.full(size, 200.0), 'zone_axis': np.full(size, '011'),
+                'convergence_angle': np.full(size, 9.75)}
+    for i, thickness in enumerate(np.linspace(0, 1, size)):
+        images[i] = Database.to_display_gray(synthetic_pattern(rng, (side, side), thickness)).reshape(-1)
+    images.flush()
+    files = [f'{t:0.2f} nm.tif' for t in metadata['thickness']]
+    return Database.SimulationLibrary(images, (side, side), files, metadata)
+
+
+# run function repeats times, returns the latency of every run in seconds, the peak traced memory (bytes)
+# and the last result
+# the memory is traced during the first run only, which is left out of the latencies when there are
+# more runs since tracing slows the allocations down
+def measure(function, repeats=1):
+    latencies = []
+    with contextlib.redirect_stderr(io.StringIO()):     # the rotate step prints every angle
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = function()
+        latencies.append(time.perf_counter() - start)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        for _ in range(repeats - 1):
+            start = time.perf_counter()
+            result = function()
+            latencies.append(time.perf_counter() - start)
+    return latencies[1:] or latencies, peak, result
+
+
+# summary of the latencies of one stage, count is the number of images handled per run
+def stage_report(latencies, peak, count=1):
+    latencies = np.asarray(latencies)
+    return {'median_ms': float(np.median(latencies) * 1000), 'min_ms': float(latencies.min() * 1000),
+            'max_ms': float(latencies.max() * 1000), 'images_per_second': float(count / np.median(latencies)),
+            'peak_memory_mb': peak / 2 ** 20}
+
+
+# per-stage latency of the preprocessing of one experimental image
+def bench_preprocessing(rng, repeats):
+    image = synthetic_experiment(rng)
+    stages = {}
+
+    def run(name, function):
+        latencies, peak, result = measure(function, repeats)
+        stages[name] = stage_report(latencies, peak)
+        return result
+
+    rendered = run('render', lambda: Database.render_figure(image))
+    centered = run('center', lambda: Database.center_pattern(rendered))
+    blown_up = run('blow_up', lambda: Database.blow_up(centered))
+    resized = run('crop', lambda: Database.crop_center(blown_up))
+    run('rotate', lambda: Database.rotate_pattern(resized))
+    processed = run('total', lambda: Database.pre_process_array(Database.render_figure(image), debug=False))
+    return stages, processed
+
+
+# matching stages against one synthetic library size
+def bench_matching(rng, size, directory, repeats, workers):
+    latencies, peak, library = measure(lambda: synthetic_library(rng, size, directory))
+    stages = {'build_library': stage_report(latencies, peak, size)}
+    exp_image = Database.to_display_gray(synthetic_pattern(rng, (Database.PROCESSED_SIZE,) * 2, 0.37))
+
+    def run(name, function, count=size):
+        latencies, peak, result = measure(function, repeats)
+        stages[name] = stage_report(latencies, peak, count)
+        return result
+
+    run('score', lambda: Database.score_library(exp_image, library.images))
+    run('score_parallel', lambda: library.score(exp_image, workers))
+    for count in WORKER_COUNTS:
+        run(f'score_parallel_{count}_workers', lambda: library.score(exp_image, count))
+    run('top_k', lambda: library.top_k(exp_image, 5, workers))
+    library.pyramid(Database.PYRAMID_SIZE)
+    run('coarse_to_fine', lambda: library.coarse_to_fine(exp_image, workers=workers))
+
+    latencies, peak, index = measure(lambda: Database.FeatureIndex.build(library))
+    stages['build_index'] = stage_report(latencies, peak, size)
+    run('index_match', lambda: index.match(library, exp_image))
+    result = run('match_result', lambda: library.match_result(np.arange(size), library.score(exp_image, workers)))
+    return {'library_size': size, 'best_thickness_nm': result.thickness, 'stages': stages}
+
+
+# the original get_best_image: the simulation file decoded and fitted to the experimental image with curve_fit,
+# kept here so the loop the GUI used to run can still be timed
+def curve_fit_best_image(filename, sim_path):
+    from scipy.optimize import curve_fit
+
+    def linear_func(x, a, b):
+        return a * x + b
+
+    flatten_image1 = np.array(Image.open(filename)).reshape(-1)
+    flatten_image2 = np.array(Image.open(sim_path).convert('L')).reshape(-1)
+    params, _ = curve_fit(linear_func, flatten_image1, flatten_image2)
+    fitted_line = linear_func(flatten_image1, *params)
+    return np.mean((flatten_image2 - fitted_line) ** 2) / 100, sim_path
+
+
+# the legacy loop of the GUI, every simulation decoded from disk and scored on its own: with the original
+# curve_fit (curve_fit_per_file) and with today's closed-form get_best_image (get_best_image_per_file)
+def bench_get_best_image(rng, directory, count=120):
+    side = Database.PROCESSED_SIZE
+    exp_path = os.path.join(directory, 'exp.tif')
+    cv2.imwrite(exp_path, Database.to_display_gray(synthetic_pattern(rng, (side, side), 0.37)))
+    names = []
+    for i, thickness in enumerate(np.linspace(0, 1, count)):
+        names.append(f'{i + 1} nm.tif')
+        cv2.imwrite(os.path.join(directory, names[-1]), Database.to_display_gray(synthetic_pattern(rng, (side, side), thickness)))
+
+    Database.directory_path = directory
+    stages = {}
+    latencies, peak, _ = measure(lambda: [curve_fit_best_image(exp_path, os.path.join(directory, name)) for name in names])
+    stages['curve_fit_per_file'] = stage_report(latencies, peak, count)
+    latencies, peak, _ = measure(lambda: [Database.get_best_image(exp_path, name) for name in names])
+    stages['get_best_image_per_file'] = stage_report(latencies, peak, count)
+    return {'library_size': count, 'stages': stages}
+
+
+# the import statements gui.py runs before its window is first drawn (above the WINDOW_TIME assignment), so the
+# GUI's own imports are checked without a display
+def gui_startup_imports(path):
+    with open(path) as file:
+        source = file.read()
+    tree = ast.parse(source)
+    window_line = next(node.lineno for node in tree.body if isinstance(node, ast.Assign)
+                       and any(getattr(target, 'id', None) == 'WINDOW_TIME' for target in node.targets))
+    return '\n'.join(ast.get_source_segment(source, node) for node in tree.body
+                     if isinstance(node, (ast.Import, ast.ImportFrom)) and node.lineno < window_line)
+
+
+# heavy modules among the names of the loaded modules
+def heavy_modules(modules):
+    return [name for name in HEAVY_MODULES if name in modules]
+
+
+# import time of Database and of the GUI's imports in a fresh interpreter (median of repeats) and the heavy modules
+# they load, and the time until the GUI window is drawn and the heavy modules loaded by then when a display is
+# available (the GUI closes itself when TEM_STARTUP_BENCHMARK is set)
+def bench_startup(repeats):
+    here = os.path.dirname(os.path.abspath(__file__))
+    results, heavy = {}, set()
+    for name, imports in (('database', 'import Database'), ('gui', gui_startup_imports(os.path.join(here, 'gui.py')))):
+        runs = []
+        for _ in range(repeats):
+            output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT.format(imports=imports)], cwd=here,
+                                    capture_output=True, text=True)
+            if output.returncode != 0:
+                results[f'import_{name}_error'] = output.stderr.strip().splitlines()[-1]
+                break
+            runs.append(json.loads(output.stdout.splitlines()[-1]))
+        if runs:
+            results[f'import_{name}_ms'] = float(np.median([run['seconds'] for run in runs]) * 1000)
+            heavy.update(heavy_modules(runs[0]['modules']))
+
+    if os.environ.get('DISPLAY') or sys.platform in ('win32', 'darwin'):
+        environment = dict(os.environ, TEM_STARTUP_BENCHMARK='1')
+        runs = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, 'gui.py'], cwd=here, env=environment, capture_output=True, text=True)
+            if output.returncode != 0:
+                results['gui_error'] = output.stderr.strip().splitlines()[-1]
+                break
+            runs.append(dict(json.loads(output.stdout.splitlines()[-1]), process_seconds=time.perf_counter() - start))
+        if runs:
+            for key in ('window', 'ready', 'process'):
+                results[f'gui_{key}_ms'] = float(np.median([run[f'{key}_seconds'] for run in runs]) * 1000)
+            heavy.update(heavy_modules(runs[0]['modules']))
+    results['heavy_modules'] = sorted(heavy)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the preprocessing and matching hot paths on synthetic patterns.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help="library sizes (default: 120 1200 12000)")
+    parser.add_argument('--repeats', type=int, default=5, help="runs per stage, the median of the untraced runs is reported (default: 5)")
+    parser.add_argument('--workers', type=int, help="threads used to score the library (default: one per core)")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the synthetic patterns")
+    parser.add_argument('--output', default='benchmark_results.json', help="JSON results file")
+    parser.add_argument('--startup', action='store_true', help="only run the startup benchmark")
+    args = parser.parse_args(argv)
+
+    print("startup", file=sys.stderr)
+    startup = bench_startup(args.repeats)
+    if startup['heavy_modules']:
+        print(f"startup loads {', '.join(startup['heavy_modules'])}", file=sys.stderr)
+    if args.startup:
+        print(json.dumps(startup, indent=2))
+        failed = startup['heavy_modules'] or any(key.endswith('_error') for key in startup)
+        return 1 if failed else 0
+
+    rng = np.random.default_rng(args.seed)
+    results = {
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__,
+                        'platform': platform.platform(), 'cpu_count': os.cpu_count()},
+        'settings': vars(args),
+        'startup': startup,
+    }
+
+    print("preprocessing", file=sys.stderr)
+    results['preprocessing'], _ = bench_preprocessing(rng, args.repeats)
+
+    results['matching'] = []
+    with tempfile.TemporaryDirectory() as directory:
+        results['legacy'] = bench_get_best_image(rng, directory)
+        for size in args.sizes:
+            print(f"library of {size} patterns", file=sys.stderr)
+            results['matching'].append(bench_matching(rng, size, directory, args.repeats, args.workers))
+
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    if resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        results['peak_rss_mb'] = maxrss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    for run in [results['legacy']] + results['matching']:
+        for name, stage in run['stages'].items():
+            print(f"{run['library_size']:>6} {name:<26} {stage['median_ms']:10.1f} ms {stage['images_per_second']:12.0f} images/s "
+                  f"{stage['peak_memory_mb']:8.1f} MB")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,117 +1,156 @@
 # imports
 import matplotlib.pyplot as plt
-import os
-import pathlib                                                                  # to find database of augmented data for CNN training
+import argparse
 import numpy as np
 import tensorflow as tf                                                         # tensorflow library to create CNN
 import tensorflow_io as tfio                                                    # tensorflow_io library for TIFF image support
 from tensorflow import keras                                                    # imports for keras functions to create CNN model
-from tensorflow.keras.utils import to_categorical
-from tensorflow.keras import Sequential, layers
+from tensorflow.keras import Sequential
 from tensorflow.keras.layers import Conv2D, MaxPooling2D, Flatten, Dense
 from tensorflow.keras.metrics import Precision, Recall
-from PIL import Image                                                           # for TIFF formatting
-from skimage import transform                                                   # for image loading and pre-processing
+from cnn_predictions import toChannels, saveInputSpec                          # same input conversion as the predictions
 
-# get path for image database for CNN training
-dir = pathlib.Path("*sat*.tif")
-filePaths = tf.io.gfile.glob(str("*sat*.tif"))
-ds_train = tf.data.Dataset.from_tensor_slices(filePaths)    # create tensor dataset from image database
+# image database for CNN training
+TRAINING_PATTERN = "*sat*.tif"
 
 BATCH_SIZE = 60     # use batch of 60
+NUM_CLASSES = 120   # possible classes from 1-120nm
+INPUT_CHANNELS = 1  # 1 trains on grayscale images, 4 on the RGBA figure TIFFs as they are
+INPUT_SIZE = 384    # side of the model input, smaller sizes (e.g. 192) downsample the 384 x 384 images
+VALIDATION_FRACTION = 0.3
+SPLIT_SEED = 403    # seed of the training/validation split
 
-# function to process each image in the dataset
-# outputs decoded image and corresponding binary vector label
-def process_path(filePath):
-    # decode TIFF image file so it's in a form the CNN can use
-    img = tf.io.read_file(filePath)
-    img = tfio.experimental.image.decode_tiff(img)
-
-    # get class from file name
-    className = tf.strings.split(filePath, " nm")[0]
-    className = tf.strings.regex_replace(className, './', '')
-
-    # possible classes from 1-120nm
-    classNames = []
-    for i in range(1, 121):
-        classNames.append(str(i))
-
-    # use one-hot encoding to create a binary vector for the class
-    # vector length is number of classes (120)--point is 1 for class match, 0 otherwise
-    labels = tf.one_hot(tf.argmax(tf.cast(tf.equal(classNames, className), tf.int32)), depth=len(classNames))
-
-    return img, labels      # return decoded image and binary vector label for TIFF image
-
-# create training dataset
-ds_train = ds_train.map(process_path, num_parallel_calls=tf.data.experimental.AUTOTUNE)
-
-# shuffle for randomization
-ds_size = ds_train.cardinality().numpy()
-ds_train = ds_train.shuffle(buffer_size=ds_size)
-
-# divide into training and validation datasets using a 70:30 ratio
-num_samples = int(0.3 * ds_size)
-ds_validation = ds_train.take(num_samples)
-
-# divide into batches using batch size
-ds_train = ds_train.skip(num_samples).batch(BATCH_SIZE).prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
-ds_validation = ds_validation.batch(BATCH_SIZE).prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
-
-# loop through each training batch to confirm correct batching and classes
-for batch_images, batch_class_names in ds_train:
-    print("Batch shape:", batch_images.shape)
-    print("Batch class names:", batch_class_names)
+# decoded images are cached after the first epoch so the TIFF files are only decoded once
+# "" keeps the cache in memory, a file name (e.g. "cnn_cache/train") keeps it on disk for datasets that do not fit
+TRAIN_CACHE = ""
+VALIDATION_CACHE = ""
 
 # CNN model
 # variables for each layer
-INPUT_SHAPE = (384, 384, 4)
+INPUT_SHAPE = (INPUT_SIZE, INPUT_SIZE, INPUT_CHANNELS)
 FILTER1_SIZE = 32
 FILTER2_SIZE = 64
 FILTER3_SIZE = 128
 FILTER_SHAPE = (4, 4)
 POOL_SHAPE = (4, 4)
 FULLY_CONNECT_NUM = 264
-NUM_CLASSES = 120
-
-# create model and add each convolution and pooling layer
-model = Sequential()
-# use 4 x 4 filters for convolution layer
-# first convolution layer creates 32 filters
-# strides=(1,1), padding="same" ensure zero-padding such that input and output sizes match
-model.add(Conv2D(FILTER1_SIZE, FILTER_SHAPE, strides=(1, 1), padding="same", activation='relu', input_shape=INPUT_SHAPE))
-model.add(MaxPooling2D(POOL_SHAPE))     # use 4 x 4 shape for pooling layer
-
-# repeat for 64 filters
-model.add(Conv2D(FILTER2_SIZE, FILTER_SHAPE, strides=(1, 1), padding="same", activation='relu'))
-model.add(MaxPooling2D(POOL_SHAPE))
-
-# repeat for 128 filters
-model.add(Conv2D(FILTER3_SIZE, FILTER_SHAPE, strides=(1, 1), padding="same", activation='relu'))
-model.add(MaxPooling2D(POOL_SHAPE))
-
-# flattened neutral network for output
-model.add(Flatten())    # flatten convolution layers
-model.add(Dense(FULLY_CONNECT_NUM, activation='relu'))      # create hidden layer of size 264
-model.add(Dense(NUM_CLASSES, activation='softmax'))         # output for each class (1-120nm)
 
 EPOCHS = 60		# use 60 epochs
+MODEL_PATH = "thicknessCNN.keras"   # trained model is saved here
 
-# show accuracy, precision, and recall for each epoch
-METRICS = metrics=['accuracy',
-               	Precision(name='precision'),
-               	Recall(name='recall')]
+# function to find the image files of the training database, sorted so the split is the same on every run
+def find_training_files(pattern=TRAINING_PATTERN):
+    return sorted(tf.io.gfile.glob(str(pattern)))
 
-# use cross entropy loss for biasing
-model.compile(optimizer=keras.optimizers.Adam(),
-          	loss=keras.losses.CategoricalCrossentropy(),
-          	metrics = METRICS)
+# function to get the class index (0 for 1nm ... 119 for 120nm) from the file name, e.g. "17 nm_sat_3.tif"
+def parse_label(filePath):
+    fileName = tf.strings.regex_replace(filePath, r'^.*[/\\]', '')     # drop the directory
+    className = tf.strings.split(fileName, " nm")[0]
+    return tf.strings.to_number(className, out_type=tf.int32) - 1
 
-# train model to training dataset and validate with validation dataset
-training_history = model.fit(ds_train,
-                	epochs=EPOCHS, batch_size=BATCH_SIZE,
-                	validation_data=ds_validation)
+# function to decode a TIFF image file, converted to the channels and resized to the size the model uses
+# the result stays 8 bit so the cached dataset is as small as possible
+def decode_image(filePath, inputSize=INPUT_SIZE, channels=INPUT_CHANNELS):
+    img = tf.io.read_file(filePath)
+    img = tfio.experimental.image.decode_tiff(img)
+    img = toChannels(img, channels)
+    if inputSize != 384:
+        img = tf.cast(tf.image.resize(img, (inputSize, inputSize), antialias=True), tf.uint8)
+    return img
 
-model.save("thicknessCNN.keras")    # save trained model
+# function to scale the cached 8 bit images to 0-1, the same normalization as cnn_predictions
+def normalize(img, labels):
+    return tf.cast(img, tf.float32) / 255, labels
+
+# function to process each image in the dataset
+# outputs decoded image and corresponding binary vector label
+def process_path(filePath, inputSize=INPUT_SIZE, channels=INPUT_CHANNELS):
+    # use one-hot encoding to create a binary vector for the class
+    # vector length is number of classes (120)--point is 1 for class match, 0 otherwise
+    labels = tf.one_hot(parse_label(filePath), depth=NUM_CLASSES)
+
+    return decode_image(filePath, inputSize, channels), labels      # return decoded image and binary vector label for TIFF image
+
+# function to split the image files into training and validation files
+# the files are shuffled once with a fixed seed, so no image moves between the two sets from one epoch to the next
+def split_files(filePaths, validationFraction=VALIDATION_FRACTION, seed=SPLIT_SEED):
+    order = np.random.default_rng(seed).permutation(len(filePaths))
+    numValidation = int(validationFraction * len(filePaths))
+    validationFiles = [filePaths[i] for i in order[:numValidation]]
+    trainFiles = [filePaths[i] for i in order[numValidation:]]
+    return trainFiles, validationFiles
+
+# function to create a batched dataset from image files
+# images are decoded once and cached, only the order of the cached images is shuffled every epoch
+def make_dataset(filePaths, cache="", shuffle=False, inputShape=INPUT_SHAPE, batchSize=BATCH_SIZE):
+    ds = tf.data.Dataset.from_tensor_slices(filePaths)      # create tensor dataset from image database
+    ds = ds.map(lambda filePath: process_path(filePath, inputShape[0], inputShape[2]),
+                num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    ds = ds.cache(cache)
+    if shuffle:
+        ds = ds.shuffle(buffer_size=len(filePaths), reshuffle_each_iteration=True)     # shuffle for randomization
+    ds = ds.map(normalize, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return ds.batch(batchSize).prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+
+# function to create the training and validation datasets using a 70:30 ratio
+def build_datasets(filePaths, inputShape=INPUT_SHAPE, batchSize=BATCH_SIZE, trainCache=TRAIN_CACHE, validationCache=VALIDATION_CACHE):
+    trainFiles, validationFiles = split_files(filePaths)
+    ds_train = make_dataset(trainFiles, trainCache, shuffle=True, inputShape=inputShape, batchSize=batchSize)
+    ds_validation = make_dataset(validationFiles, validationCache, inputShape=inputShape, batchSize=batchSize)
+    return ds_train, ds_validation
+
+# function to create the compiled CNN model
+def build_model(inputShape=INPUT_SHAPE):
+    # create model and add each convolution and pooling layer
+    model = Sequential()
+    # use 4 x 4 filters for convolution layer
+    # first convolution layer creates 32 filters
+    # strides=(1,1), padding="same" ensure zero-padding such that input and output sizes match
+    model.add(Conv2D(FILTER1_SIZE, FILTER_SHAPE, strides=(1, 1), padding="same", activation='relu', input_shape=inputShape))
+    model.add(MaxPooling2D(POOL_SHAPE))     # use 4 x 4 shape for pooling layer
+
+    # repeat for 64 filters
+    model.add(Conv2D(FILTER2_SIZE, FILTER_SHAPE, strides=(1, 1), padding="same", activation='relu'))
+    model.add(MaxPooling2D(POOL_SHAPE))
+
+    # repeat for 128 filters
+    model.add(Conv2D(FILTER3_SIZE, FILTER_SHAPE, strides=(1, 1), padding="same", activation='relu'))
+    model.add(MaxPooling2D(POOL_SHAPE))
+
+    # flattened neutral network for output
+    model.add(Flatten())    # flatten convolution layers
+    model.add(Dense(FULLY_CONNECT_NUM, activation='relu'))      # create hidden layer of size 264
+    model.add(Dense(NUM_CLASSES, activation='softmax'))         # output for each class (1-120nm)
+
+    # show accuracy, precision, and recall for each epoch
+    metrics = ['accuracy', Precision(name='precision'), Recall(name='recall')]
+
+    # use cross entropy loss for biasing
+    model.compile(optimizer=keras.optimizers.Adam(),
+              	loss=keras.losses.CategoricalCrossentropy(),
+              	metrics=metrics)
+    return model
+
+# class that builds a CNN model for an input shape, trains it and saves it with its input spec
+class ThicknessTrainer:
+    def __init__(self, inputShape=INPUT_SHAPE):
+        self.inputShape = tuple(inputShape)
+        self.model = build_model(self.inputShape)
+        self.history = None
+
+    # train model to training dataset and validate with validation dataset
+    def fit(self, ds_train, ds_validation, epochs=EPOCHS):
+        self.history = self.model.fit(ds_train, epochs=epochs, validation_data=ds_validation)
+        return self.history
+
+    # save trained model and the input shape and colour mode it expects
+    def save(self, modelPath=MODEL_PATH):
+        self.model.save(modelPath)
+        saveInputSpec(modelPath, self.inputShape)
+
+    # evaluate metrics of final epoch for each dataset
+    def evaluate(self, *datasets):
+        return [self.model.evaluate(ds, return_dict=True) for ds in datasets]
 
 # create function to show matrics over the epochs for both training and validation metrics
 def show_performance_curve(training_result, metric, metric_label):
@@ -127,8 +166,29 @@ def show_performance_curve(training_result, metric, metric_label):
 	plt.ylabel(metric_label)
 	plt.legend(loc='upper left')
 
-show_performance_curve(training_history, 'accuracy', 'accuracy')    # metrics plot for accuracy and validation accuracy
-show_performance_curve(training_history, 'precision', 'precision')      # metrics plot for precision and validation precision
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train the thickness CNN on the augmented simulation images.")
+    parser.add_argument('--images', default=TRAINING_PATTERN, help=f"glob of the training images (default: {TRAINING_PATTERN})")
+    parser.add_argument('--epochs', type=int, default=EPOCHS, help=f"training epochs (default: {EPOCHS})")
+    parser.add_argument('--model', default=MODEL_PATH, help=f"file the trained model is saved to (default: {MODEL_PATH})")
+    args = parser.parse_args(argv)
+
+    ds_train, ds_validation = build_datasets(find_training_files(args.images))
+
+    # loop through each training batch to confirm correct batching and classes
+    for batch_images, batch_class_names in ds_train:
+        print("Batch shape:", batch_images.shape)
+        print("Batch class names:", batch_class_names)
+
+    trainer = ThicknessTrainer(INPUT_SHAPE)
+    training_history = trainer.fit(ds_train, ds_validation, args.epochs)
+    trainer.save(args.model)    # save trained model
+
+    show_performance_curve(training_history, 'accuracy', 'accuracy')    # metrics plot for accuracy and validation accuracy
+    show_performance_curve(training_history, 'precision', 'precision')      # metrics plot for precision and validation precision
+
+    trainer.evaluate(ds_train, ds_validation)       # evaluate metrics of final epoch for training and validation datasets
+    return 0
 
-model.evaluate(ds_train, return_dict=True)      # evaluate metrics of final epoch for training dataset
-model.evaluate(ds_validation, return_dict=True)     # evaluate metrics of final epoch for validation dataset
+if __name__ == "__main__":
+    main()
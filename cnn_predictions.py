@@ -1,73 +1,19 @@
 # imports
-import matplotlib.pyplot as plt
+import argparse
+import json
 import os
-import pathlib                                                                  # to find database of augmented data for CNN training
+import pathlib                                                                  # to list the images of a directory
 import numpy as np
+import pandas as pd                                                             # for the table of predictions
 import tensorflow as tf                                                         # tensorflow library to create CNN
 import tensorflow_io as tfio                                                    # tensorflow_io library for TIFF image support
-from tensorflow import keras                                                    # imports for keras functions to create CNN model
-from tensorflow.keras.utils import to_categorical
-from tensorflow.keras import Sequential, layers
-from tensorflow.keras.layers import Conv2D, MaxPooling2D, Flatten, Dense
-from tensorflow.keras.metrics import Precision, Recall
 from PIL import Image                                                           # for TIFF formatting
 from skimage import transform                                                   # for image loading and pre-processing
 
-# get path for image database for CNN training
-dir = pathlib.Path("*sat*.tif")
-filePaths = tf.io.gfile.glob(str("*sat*.tif"))
-ds_train = tf.data.Dataset.from_tensor_slices(filePaths)    # create tensor dataset from image database
-
 BATCH_SIZE = 60     # use batch of 60
 
-# function to process each image in the dataset
-# outputs decoded image and corresponding binary vector label
-def process_path(filePath):
-    # decode TIFF image file so it's in a form the CNN can use
-    img = tf.io.read_file(filePath)
-    img = tfio.experimental.image.decode_tiff(img)
-
-    # get class from file name
-    className = tf.strings.split(filePath, " nm")[0]
-    className = tf.strings.regex_replace(className, './', '')
-
-    # possible classes from 1-120nm
-    classNames = []
-    for i in range(1, 121):
-        classNames.append(str(i))
-
-    # use one-hot encoding to create a binary vector for the class
-    # vector length is number of classes (120)--point is 1 for class match, 0 otherwise
-    labels = tf.one_hot(tf.argmax(tf.cast(tf.equal(classNames, className), tf.int32)), depth=len(classNames))
-
-    return img, labels      # return decoded image and binary vector label for TIFF image
-
-# create training dataset
-ds_train = ds_train.map(process_path, num_parallel_calls=tf.data.experimental.AUTOTUNE)
-
-# shuffle for randomization
-ds_size = ds_train.cardinality().numpy()
-ds_train = ds_train.shuffle(buffer_size=ds_size)
-
-# divide into training and validation datasets using a 70:30 ratio
-num_samples = int(0.3 * ds_size)
-ds_validation = ds_train.take(num_samples)
-
-# divide into batches using batch size
-ds_train = ds_train.skip(num_samples).batch(BATCH_SIZE).prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
-ds_validation = ds_validation.batch(BATCH_SIZE).prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
-
-# loop through each training batch to confirm correct batching and classes
-for batch_images, batch_class_names in ds_train:
-    print("Batch shape:", batch_images.shape)
-    print("Batch class names:", batch_class_names)
-
-# CNN model
-newModel = tf.keras.models.load_model('thicknessCNN_afterTraining_sat_60epoch_acc-76_predFresh-96_4-15s.keras')     # load trained model
-newModel.summary()      # show model architecture
-
-newModel.evaluate(ds_train, return_dict=True)       # evaluate metrics of final epoch for training dataset using loaded model
-newModel.evaluate(ds_validation, return_dict=True)      # evaluate metrics of final epoch for validation dataset using loaded model
+# trained model used when no other model is given
+MODEL_PATH = 'thicknessCNN_afterTraining_sat_60epoch_acc-76_predFresh-96_4-15s.keras'
 
 # create array of class names (1-120nm)
 classNames = []
@@ -75,142 +21,178 @@ for i in range(1, 121):
     classNames.append(str(i))
 
 # function to load individual TIFF image file
-def loadImg(filename):
-   np_image = Image.open(filename)                          # open file
+# inputShape is the (height, width, channels) the model expects, 1 channel is grayscale
+def loadImg(filename, inputShape=(384, 384, 4)):
+   np_image = Image.open(filename).convert('L' if inputShape[2] == 1 else 'RGBA')     # open file
    np_image = np.array(np_image).astype('float32')/255      # normalize
-   np_image = transform.resize(np_image, (384, 384, 4))     # resize to match model input size
+   np_image = transform.resize(np_image, inputShape)        # resize to match model input size
    np_image = np.expand_dims(np_image, axis=0)
    return np_image      # return image
 
-numCorrect = 0;     # use to check CNN prediction accuracy
-
-# loop through each 0-tilt simulation image for 1-120nm
-for i in range(1, 121):
-    image5 = loadImg(str(i) + ' nm.tif')        # load image
-    prediction5 = newModel.predict(image5)      # use CNN to make prediction
+# function to convert decoded RGBA pixels to the channels a model expects
+# 1 channel is the grayscale of the RGB channels (the PACBED signal is gray), otherwise the first channels are kept
+def toChannels(img, channels):
+    if channels == 1:
+        return tf.image.rgb_to_grayscale(img[..., :3])
+    return img[..., :channels]
 
-    # post-process prediction to get class
-    predicted_class_index5 = np.argmax(prediction5, axis=1)[0]
-    predicted_class_name5 = classNames[predicted_class_index5]
+# function to decode and resize one TIFF image file inside a tf.data pipeline
+# same normalization as loadImg: scaled to 0-1 and resized to the model input size
+def decodeImg(filePath, inputShape):
+    img = tf.io.read_file(filePath)
+    img = tfio.experimental.image.decode_tiff(img)              # RGBA, 4 channels
+    img = tf.cast(toChannels(img, inputShape[2]), tf.float32) / 255   # keep the channels the model expects
+    return tf.image.resize(img, inputShape[:2], antialias=True)
+
+# input spec saved next to a trained model as <model>.json: the input shape and colour mode it was trained on
+def specPath(modelPath):
+    return str(modelPath) + '.json'
+
+# function to save the input spec of a trained model
+def saveInputSpec(modelPath, inputShape):
+    spec = {'input_shape': [int(n) for n in inputShape], 'color_mode': 'grayscale' if inputShape[2] == 1 else 'rgba',
+            'scale': 1 / 255}
+    with open(specPath(modelPath), 'w') as file:
+        json.dump(spec, file, indent=2)
+
+# function to read the input shape of a trained model, from its spec file or else from the model itself
+def loadInputShape(modelPath, model):
+    if os.path.exists(specPath(modelPath)):
+        with open(specPath(modelPath)) as file:
+            return tuple(json.load(file)['input_shape'])
+    return tuple(model.input_shape[1:])
+
+# function to convert an in-memory image (e.g. a processed experimental image from Database) to model input
+# grayscale images are repeated into opaque RGBA for 4 channel models, colour images are converted like TIFF files
+def prepareArray(image, inputShape):
+    img = tf.convert_to_tensor(np.asarray(image))
+    if img.shape.rank == 2:
+        img = img[..., tf.newaxis]
+    if img.shape[-1] == 1 and inputShape[2] != 1:
+        img = tf.image.grayscale_to_rgb(img)
+        img = tf.concat([img, tf.fill(tf.shape(img[..., :1]), tf.constant(255, img.dtype))], axis=-1)    # opaque alpha
+    elif img.shape[-1] != 1:
+        img = toChannels(img, inputShape[2])
+    img = tf.cast(img, tf.float32) / 255
+    return tf.image.resize(img, inputShape[:2], antialias=True)
+
+# function to expand a directory, a single file or a list of files into a list of image files
+def listImages(images):
+    if isinstance(images, (str, os.PathLike)):
+        if os.path.isdir(images):
+            return sorted(str(path) for path in pathlib.Path(images).iterdir() if path.suffix.lower() in ('.tif', '.tiff'))
+        return [str(images)]
+    return [str(image) for image in images]
+
+# class that loads a trained model once and predicts the thickness of many images in batches
+class ThicknessPredictor:
+    def __init__(self, modelPath=MODEL_PATH):
+        self.modelPath = modelPath
+        self.model = tf.keras.models.load_model(modelPath)      # load trained model once
+        self.inputShape = loadInputShape(modelPath, self.model)     # (height, width, channels) the model expects
+
+    # create batched dataset of decoded and resized images
+    def dataset(self, filePaths, batchSize=BATCH_SIZE):
+        ds = tf.data.Dataset.from_tensor_slices(filePaths)
+        ds = ds.map(lambda filePath: decodeImg(filePath, self.inputShape), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        return ds.batch(batchSize).prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+
+    # predict a directory, a single file or a list of files
+    # returns a table with the predicted class (nm), its probability (confidence) and the top k classes and probabilities
+    def predict(self, images, batchSize=BATCH_SIZE, topK=3):
+        filePaths = listImages(images)
+        if not filePaths:
+            return pd.DataFrame(columns=['file', 'predicted_class', 'confidence', 'top_classes', 'top_probabilities'])
+
+        probabilities = self.model.predict(self.dataset(filePaths, batchSize), verbose=0)
+        return self.table(filePaths, probabilities, topK)
+
+    # predict in-memory 8 bit images (see prepareArray), the file column of the table holds their index
+    def predictArrays(self, images, batchSize=BATCH_SIZE, topK=3):
+        batch = tf.stack([prepareArray(image, self.inputShape) for image in images])
+        probabilities = self.model.predict(batch, batch_size=batchSize, verbose=0)
+        return self.table(list(range(len(images))), probabilities, topK)
+
+    # post-process predictions into a table, one row per image
+    def table(self, names, probabilities, topK=3):
+        topIndices = np.argsort(probabilities, axis=1)[:, ::-1][:, :topK]
+        topProbabilities = np.take_along_axis(probabilities, topIndices, axis=1)
+        return pd.DataFrame({
+            'file': names,
+            'predicted_class': [int(classNames[i]) for i in topIndices[:, 0]],
+            'confidence': topProbabilities[:, 0],
+            'top_classes': [[int(classNames[i]) for i in row] for row in topIndices],
+            'top_probabilities': [list(row) for row in topProbabilities],
+        })
+
+# post-processed images from the data processing subsystem and their expected classes
+EXPERIMENT_CLASSES = {
+    'exp_img1.tif': 17,
+    'exp_img2.tif': 49,
+    'exp_img3.tif': 12,
+    'exp_img4.tif': 39,
+    'exp_img5.tif': 48,
+    'exp_img6.tif': 18,
+    'exp_img7.tif': 14,
+    'exp_img8.tif': 14,
+}
+
+# function to create a batched dataset of images and one-hot labels, decoded to the input spec of the predictor
+def labeledDataset(predictor, filePaths, batchSize=BATCH_SIZE):
+    from cnn_model_creation import NUM_CLASSES, parse_label     # imported here since cnn_model_creation imports this module
+    ds = tf.data.Dataset.from_tensor_slices(filePaths)
+    ds = ds.map(lambda filePath: (decodeImg(filePath, predictor.inputShape), tf.one_hot(parse_label(filePath), depth=NUM_CLASSES)),
+                num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return ds.batch(batchSize).prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+
+# function to evaluate the metrics of a loaded model on the training images
+# the images are split into the same training and validation files as in cnn_model_creation
+def evaluateTraining(predictor, pattern="*sat*.tif"):
+    from cnn_model_creation import find_training_files, split_files
+    trainFiles, validationFiles = split_files(find_training_files(pattern))
+    ds_train = labeledDataset(predictor, trainFiles)
+    ds_validation = labeledDataset(predictor, validationFiles)
+
+    # loop through each training batch to confirm correct batching and classes
+    for batch_images, batch_class_names in ds_train:
+        print("Batch shape:", batch_images.shape)
+        print("Batch class names:", batch_class_names)
+
+    trainMetrics = predictor.model.evaluate(ds_train, return_dict=True)       # evaluate metrics of final epoch for training dataset using loaded model
+    validationMetrics = predictor.model.evaluate(ds_validation, return_dict=True)      # evaluate metrics of final epoch for validation dataset using loaded model
+    return trainMetrics, validationMetrics
+
+# function to predict images with known classes in one batch
+# prediction deemed correct if within +-tolerance nm of expected class, returns the accuracy percentage
+def accuracy(predictor, expectedClasses, tolerance=4):
+    predictions = predictor.predict(list(expectedClasses))
+    predictions['expected_class'] = list(expectedClasses.values())
 
     # compare expected and predicted class
-    print("Expected class:", i, "nm")
-    print("Predicted class:", predicted_class_name5, "nm")
-
-    # prediction deemed correct if within +-4nm of expected class
-    if (abs(i - int(predicted_class_name5)) <= 4):
-        numCorrect += 1
-
-print(numCorrect/120*100)   # find accuracy percentage
-
-predCorr = 0;   # use to check CNN prediction accuracy for SAS images
-
-# image 1
-image3 = loadImg('exp_img1.tif')            # load post-processed image from data processing subsystem
-prediction3 = newModel.predict(image3)      # use CNN to make prediction
-
-# post-process prediction to get class
-predicted_class_index3 = np.argmax(prediction3, axis=1)[0]
-predicted_class_name3 = classNames[predicted_class_index3]
-
-# compare expected and predicted class
-print("Expected class:", 17, "nm")      # expected class gotten from data processing subsystem
-print("Predicted class:", predicted_class_name3, "nm")
-
-# prediction deemed correct if within +-4nm of expected class
-if (abs(17 - int(predicted_class_name3)) <= 4):
-    predCorr += 1
-
-# repeat for each image provided by SAS and after processing from data processing subsystem
-# image 2
-image4 = loadImg('exp_img2.tif')
-prediction4 = newModel.predict(image4)
-
-predicted_class_index4 = np.argmax(prediction4, axis=1)[0]
-predicted_class_name4 = classNames[predicted_class_index4]
-
-print("Expected class:", 49, "nm")
-print("Predicted class:", predicted_class_name4, "nm")
-
-if (abs(49 - int(predicted_class_name4)) <= 4):
-    predCorr += 1
-
-# image 3
-image6 = loadImg('exp_img3.tif')
-prediction6 = newModel.predict(image6)
-
-predicted_class_index6 = np.argmax(prediction6, axis=1)[0]
-predicted_class_name6 = classNames[predicted_class_index6]
-
-print("Expected class:", 12, "nm")
-print("Predicted class:", predicted_class_name6, "nm")
-
-if (abs(12 - int(predicted_class_name6)) <= 4):
-    predCorr += 1
-
-# image 4
-image7 = loadImg('exp_img4.tif')
-prediction7 = newModel.predict(image7)
-
-predicted_class_index7 = np.argmax(prediction7, axis=1)[0]
-predicted_class_name7 = classNames[predicted_class_index7]
-
-print("Expected class:", 39, "nm")
-print("Predicted class:", predicted_class_name7, "nm")
-
-if (abs(39 - int(predicted_class_name7)) <= 4):
-    predCorr += 1
-
-# image 5
-image8 = loadImg('exp_img5.tif')
-prediction8 = newModel.predict(image8)
-
-predicted_class_index8 = np.argmax(prediction8, axis=1)[0]
-predicted_class_name8 = classNames[predicted_class_index8]
-
-print("Expected class:", 48, "nm")
-print("Predicted class:", predicted_class_name8, "nm")
-
-if (abs(48 - int(predicted_class_name8)) <= 4):
-    predCorr += 1
-
-# image 6
-image9 = loadImg('exp_img6.tif')
-prediction9 = newModel.predict(image9)
-
-predicted_class_index9 = np.argmax(prediction9, axis=1)[0]
-predicted_class_name9 = classNames[predicted_class_index9]
-
-print("Expected class:", 18, "nm")
-print("Predicted class:", predicted_class_name9, "nm")
-
-if (abs(18 - int(predicted_class_name9)) <= 4):
-    predCorr += 1
-
-# image 7
-image10 = loadImg('exp_img7.tif')
-prediction10 = newModel.predict(image10)
-
-predicted_class_index10 = np.argmax(prediction10, axis=1)[0]
-predicted_class_name10 = classNames[predicted_class_index10]
-
-print("Expected class:", 14, "nm")
-print("Predicted class:", predicted_class_name10, "nm")
+    for expected, predicted in zip(predictions['expected_class'], predictions['predicted_class']):
+        print("Expected class:", expected, "nm")
+        print("Predicted class:", predicted, "nm")
 
-if (abs(14 - int(predicted_class_name10)) <= 4):
-    predCorr += 1
+    numCorrect = (abs(predictions['expected_class'] - predictions['predicted_class']) <= tolerance).sum()
+    return numCorrect/len(expectedClasses)*100
 
-# image 8
-image11 = loadImg('exp_img8.tif')
-prediction11 = newModel.predict(image11)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluate a trained thickness CNN.")
+    parser.add_argument('--model', default=MODEL_PATH, help="trained model (default: the shipped model)")
+    parser.add_argument('--images', default="*sat*.tif", help="glob of the training images the metrics are evaluated on")
+    args = parser.parse_args(argv)
 
-predicted_class_index11 = np.argmax(prediction11, axis=1)[0]
-predicted_class_name11 = classNames[predicted_class_index11]
+    # CNN model
+    predictor = ThicknessPredictor(args.model)      # load trained model
+    predictor.model.summary()      # show model architecture
+    evaluateTraining(predictor, args.images)
 
-print("Expected class:", 14, "nm")
-print("Predicted class:", predicted_class_name11, "nm")
+    # predict every 0-tilt simulation image for 1-120nm in batches
+    print(accuracy(predictor, {str(i) + ' nm.tif': i for i in range(1, 121)}))   # find accuracy percentage
 
-if (abs(14 - int(predicted_class_name11)) <= 4):
-    predCorr += 1
+    # use CNN to make predictions for every image provided by SAS in one batch
+    print(accuracy(predictor, EXPERIMENT_CLASSES))   # find accuracy percentage for SAS images
+    return 0
 
-print(predCorr/8*100)   # find accuracy percentage for SAS images
+if __name__ == "__main__":
+    main()
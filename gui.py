@@ -1,14 +1,18 @@
+import time
+STARTUP_TIME = time.perf_counter()     # start of the imports, for the startup benchmark
+
 import tkinter as tk
-from tkinter import filedialog, messagebox
+from tkinter import filedialog, messagebox, ttk
 from PIL import Image, ImageTk
-from pandastable import Table, TableModel
 import pandas as pd
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib.figure import Figure
+import json
 import os
-import matplotlib.image as mpimg
-import matplotlib.pyplot as plt
+import queue
+import sys
+import threading
+import numpy as np
 import Database
+import timing
 
 """
     Team Name: Team 6 - Analytical Database for TEM Sample Thickness Determination
@@ -36,9 +40,19 @@ globalVariables = {
     'axisValue': None,
     'angleValue': None,
     'outputImg': None,
-    'updateOutputImage': None
+    'updateOutputImage': None,
+    'cancelEvent': None,
+    'matchResult': None
 }
 
+# When set, the window closes as soon as it has been drawn and the time it took to appear is printed as JSON,
+# used by the startup benchmark (python benchmark.py --startup)
+STARTUP_BENCHMARK_ENV = 'TEM_STARTUP_BENCHMARK'
+
+# Ways to determine the thickness: the MSE scan of the whole simulation library, the CNN alone, or the CNN's
+# top thicknesses scored with the MSE (only the simulations near them are scanned)
+MATCH_METHODS = ("MSE scan", "CNN estimate", "CNN + MSE")
+
 
 
 """
@@ -66,6 +80,27 @@ def convert_to_tif(filePath):
 
 
 
+"""
+    Converts a user entered parameter to a number.
+
+    Parameters:
+    ----------
+    text : str
+        The text entered by the user.
+
+    Returns:
+    -------
+    value : float
+        The entered number, or nan if the text is not a number.
+"""
+def to_number(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+
 """
     Clears the canvas of any images. Opens a file dialog for the user to select an image file. 
     The selected image is displayed in the provided label. Also creates a new window for user to input 
@@ -95,6 +130,7 @@ def load_image(input_img_label, outputImg_label, globalVariables):
     for widget in outputImg_label.winfo_children(): # Clear the canvas
         widget.destroy()
 
+    cancel_thickness(globalVariables)   # A new image replaces any thickness determination that is still running
     globalVariables['updateOutputImage'] = False
     globalVariables['outputImg'] = None
     globalVariables['loadedImage'] = None
@@ -119,6 +155,7 @@ def load_image(input_img_label, outputImg_label, globalVariables):
             tif_filePath = convert_to_tif(globalVariables['filePath'])
 
         img = Image.open(tif_filePath)
+        Figure, FigureCanvasTkAgg = figure_classes()
         fig = Figure(figsize =  (3, 3))
         ax = fig.add_subplot(111)
         ax.imshow(img, cmap = 'gray')
@@ -359,25 +396,11 @@ def retrieve_input(voltage_entry, axis_entry, angle_entry, globalVariables, inpu
 
 
 """
-    This function is used to output the image from the database that matches the input image being processed. 
-    The image is then displayed onto the GUI next to the input image. Since this function does a lot, I have
-    provided a step-by-step explaination below:
-
-        The function performs the following steps:
-        1. Checks if an image has been loaded. If not, an error message is displayed.
-        2. Reads the image from the file path specified in the global variables.
-        3. Displays the image in a new figure with black borders and no axis.
-        4. Saves the figure in the user's Downloads folder.
-        5. Processes the saved image using the pre_process_image function from the Database module.
-        6. Asks the user to select a directory where the simulations are located.
-        7. Iterates over all images in the selected directory and gets the best image for each one using the get_best_image function from the Database module.
-        8. Finds the image with the minimum error and all images with the same error.
-        9. Extracts the numerical part from the names of the images with the same error and constructs a string with the format 'number nm'.
-        10. Calculates the maximum error among the images with the same error.
-        11. Constructs a string with the format 'best +- error nm'.
-        12. Updates the measurements and results in the global variables with the material and thickness.
-        13. Updates the table in the GUI with the new measurements and results.
-        14. Displays the input image and the best fit image in the GUI.
+    This function starts the thickness determination for the loaded image with the method chosen in the Method box.
+    Unless the method is the CNN estimate alone, the user is asked for the directory where the simulations are 
+    located. The preprocessing and the library scan run on a worker thread
+    (determine_thickness) so the window stays responsive. A progress bar shows how many simulations have been
+    scored and the Cancel button stops the scan. The results are picked up on the Tk event loop by poll_thickness.
 
     Parameters:
     ----------
@@ -394,118 +417,237 @@ def output_image(globalVariables):
     if globalVariables['loadedImage'] is None:
         messagebox.showerror("Error", "No image has been loaded.")
         return
-    
-    # Load the TIFF file
-    image = mpimg.imread(globalVariables['filePath'])
-    plt.figure(facecolor = 'black')
-    
-    # Create a new figure and display the image with black borders
-    plt.imshow(image, cmap = 'gray')
-        
-    # Remove axis
-    plt.axis('off')
-    
-    # Getting the path to the user's Downloads folder
-    downloads_folder = os.path.expanduser("~/Downloads")
 
-    # Save the figure
-    bright_output_filename = os.path.join(downloads_folder, "Bright_Exp.tif")
-    plt.savefig(bright_output_filename)
-    processed_output_file = Database.pre_process_image(bright_output_filename)
+    method = method_variable.get()
+    if method != "CNN estimate":
+        Database.directory_path = filedialog.askdirectory(title = "Please select the directory where your simulations are located.")
+        if not Database.directory_path:
+            messagebox.showerror("Error", "You must select a directory.")
+            return
 
-    Database.directory_path = filedialog.askdirectory(title = "Please select the directory where your simulations are located.")
-    if not Database.directory_path:
-        messagebox.showerror("Error", "You must select a directory.")
-        return
+    determine_thickness_button.config(state = 'disabled')
+    progress_bar.config(value = 0, maximum = 1)
+    progress_frame.grid()
 
-    list_num = []
-    list_name = []
+    globalVariables['cancelEvent'] = threading.Event()
+    results = queue.Queue()
+    worker = threading.Thread(target = determine_thickness, daemon = True, args = (globalVariables['filePath'], Database.directory_path,
+        to_number(globalVariables['voltageValue']), globalVariables['axisValue'], to_number(globalVariables['angleValue']),
+        globalVariables['cancelEvent'], results, method))
+    worker.start()
 
-    for images in os.listdir(Database.directory_path):
-    # Check if the image ends with tif 
-        list_num.append(Database.get_best_image(processed_output_file, images)[0])
-        list_name.append(Database.get_best_image(processed_output_file, images)[1])
-    
-    min_value = min(list_num)
-    min_value_name = list_name[list_num.index(min_value)]
-    names_with_same_error = []
-
-    # Extract ones place and tenths place from the minimum value
-    ones_place = int(min_value) % 10
-    reference_tenths = int(min_value * 10) % 10
-
-    # Get names associated with the values at these indices
-    # Find indices of values with the same error place as the minimum value
-    indices_with_same_error = [i for i, value in enumerate(list_num) if int(value * 10) % 10 == reference_tenths and int(value) % 10 == ones_place]
-
-    # Get names associated with the values at these indices
-    names_with_same_error = [list_name[i] for i in indices_with_same_error]
-
-    number = ''.join(filter(str.isdigit, min_value_name))
-    if number:
-        result = number
-        add_on = " nm"
-        best = ''.join([result, add_on])
-    else:
-        print("No numbers found in the string.")
-
-    # Initialize a list to store the nm_best strings
-    nm_best_list = []
-
-    # Iterate over each name with the same error
-    for name in names_with_same_error:
-        number = ""
-        
-        # Iterate over each character in the name string
-        for char in name:
-            if char.isdigit():
-                number += char
-
-        if number:  # Check if any digits were found in the string
-            result = number
-            add_on = " nm"
-            nm_best = ''.join([result, add_on])  # Construct the string with the extracted number and " nm"
-            nm_best_list.append(nm_best)  # Append nm_best to the list  
-        else:
-            print("No numbers found in the string for name:", name)
-
-    numerical_value_best = int(''.join(filter(str.isdigit, best)))
-    numerical_values = []
-    error_values = []
-
-    for names in nm_best_list:
-        numerical_value = int(''.join(filter(str.isdigit, names)))  # Extract numerical par
-        numerical_values.append(numerical_value)
-        # Perform subtraction
-    for numbers in numerical_values:
-        if (numerical_value_best == numbers):
+    window.after(100, lambda: poll_thickness(results, globalVariables['cancelEvent'], globalVariables))
+
+
+
+"""
+    This function runs on a worker thread and does the slow part of the thickness determination. It must not
+    touch any tkinter widget, everything is reported through the results queue instead:
+    ('progress', done, total) while decoding a new library and while scoring, then one of ('done', match), ('cnn', estimate), ('cancelled',) or ('error', message).
+
+        The function performs the following steps:
+        1. Reads and preprocesses the image using the pre_process_file function from the Database module, which renders
+           it with black borders and no axis (render_figure) and processes it in memory (pre_process_array). The
+           processed image is cached, so the same image is only preprocessed once.
+        2. For the CNN estimate, predicts the thickness with the cached CNN (cnn_estimate from the Database module) and stops.
+        3. Opens the simulation library for the directory and scores every simulation in one pass using the SimulationLibrary class
+           from the Database module, or for CNN + MSE only the simulations near the CNN's top thicknesses.
+        4. Builds the match result (refined thickness and tilt, top matches, MSE curve and confidence) from the scores.
+
+    Every stage is timed when the TEM_TIMING environment variable is set, and profiled when TEM_PROFILE is set (see timing.py).
+
+    Parameters:
+    ----------
+    filePath : str
+        The path to the experimental image.
+
+    directory : str
+        The directory where the simulations are located.
+
+    voltage, axis, angle :
+        The Accelerating Voltage, Zone Axis and Convergence Angle entered by the user.
+
+    cancelEvent : threading.Event
+        Set by the Cancel button to stop the scan.
+
+    results : queue.Queue
+        The queue the progress and the results are posted to.
+
+    method : str
+        One of MATCH_METHODS.
+
+    Returns:
+    -------
+    None
+"""
+def determine_thickness(filePath, directory, voltage, axis, angle, cancelEvent, results, method = "MSE scan"):
+    try:
+        with timing.run('thickness_determination', image = filePath):
+            # Load the TIFF file, render it with black borders the way a matplotlib figure shows it and preprocess it
+            # in memory, or take the processed image from the cache when this image was processed before
+            processed_image = Database.pre_process_file(filePath)
+
+            # One forward pass of the CNN, loaded the first time it is used
+            if method == "CNN estimate":
+                results.put(('cnn', Database.cnn_estimate(processed_image)))
+                return
+
+            # Open the preloaded simulation library (decoded only the first time) and score it in a single pass
+            # The progress bar follows the decoding of a new or changed folder too, and Cancel stops it
+            progress = lambda done, total: results.put(('progress', done, total))
+            library = Database.SimulationLibrary.open(directory, voltage, axis, angle, progress = progress, cancel = cancelEvent)
+            if cancelEvent.is_set():
+                raise Database.MatchCancelled()
+
+            if method == "CNN + MSE":
+                thicknesses = Database.cnn_estimate(processed_image)['top_thicknesses']
+                indices, scores = library.score_near(processed_image, thicknesses, progress = progress, cancel = cancelEvent)
+            else:
+                indices = np.arange(len(library))
+                scores = library.score(processed_image, progress = progress, cancel = cancelEvent)
+            results.put(('done', library.match_result(indices, scores)))
+    except Database.MatchCancelled:
+        results.put(('cancelled',))
+    except Exception as error:
+        results.put(('error', str(error)))
+
+
+
+"""
+    This function runs on the Tk event loop and reads the messages posted by determine_thickness. It updates the 
+    progress bar and, once the worker is finished, shows the results or the error. It reschedules itself with 
+    after() until the worker is finished.
+
+    Parameters:
+    ----------
+    results : queue.Queue
+        The queue the worker posts its progress and results to.
+
+    cancelEvent : threading.Event
+        The cancel event of this worker. Results of a cancelled worker are discarded.
+
+    globalVariables : dict
+        A dictionary containing global variables.
+
+    Returns:
+    -------
+    None
+"""
+def poll_thickness(results, cancelEvent, globalVariables):
+    while True:
+        try:
+            message = results.get_nowait()
+        except queue.Empty:
+            window.after(100, lambda: poll_thickness(results, cancelEvent, globalVariables))
+            return
+
+        if globalVariables['cancelEvent'] is not cancelEvent:
+            return  # A newer thickness determination has replaced this one
+
+        if message[0] == 'progress':
+            progress_bar.config(maximum = message[2], value = message[1])
             continue
+
+        progress_frame.grid_remove()
+        globalVariables['cancelEvent'] = None
+
+        if message[0] == 'done' and not cancelEvent.is_set():
+            show_thickness(message[1], globalVariables)
+        elif message[0] == 'cnn' and not cancelEvent.is_set():
+            show_cnn_estimate(message[1], globalVariables)
         else:
-            error_values.append(abs(numbers - numerical_value_best))
-            
-    if error_values:  # Check if error_values is not empty
-        for values in error_values:
-            if (values > 2):
-                max_error = 2
-            else:
-                max_error = max(error_values)
-    else:
-        max_error = 2
-
-    error_pl = str(max_error)
-    add_on = " nm"
-    error_best = ''.join([error_pl, add_on])
-    add_PL = ' +- '
-    plus_minus = ''.join([add_PL, error_best])
-    final_value = ''.join([best, plus_minus])
-    best_fit_image = '% s' %min_value_name
+            determine_thickness_button.config(state = 'normal')
+            if message[0] == 'error':
+                messagebox.showerror("Error", message[1])
+        return
+
+
+
+"""
+    This function stops a running thickness determination. The worker thread stops after the chunk of 
+    simulations it is currently scoring.
+
+    Parameters:
+    ----------
+    globalVariables : dict
+        A dictionary containing global variables.
+
+    Returns:
+    -------
+    None
+"""
+def cancel_thickness(globalVariables):
+    if globalVariables['cancelEvent'] is not None:
+        globalVariables['cancelEvent'].set()
+
+
+
+"""
+    This function formats an estimate and its uncertainty for the results table, e.g. '37.3 nm +- 1.8 nm'.
+    The uncertainty is left out when it is unknown (nan), e.g. when the library has no neighbouring grid points.
+
+    Parameters:
+    ----------
+    value : float
+        The estimate.
+
+    error : float
+        The +- uncertainty of the estimate.
+
+    unit : str
+        The unit shown after both numbers.
+
+    Returns:
+    -------
+    str
+        The formatted estimate.
+"""
+def format_estimate(value, error, unit):
+    if np.isnan(error):
+        return f"{value:.3g} {unit}"
+    return f"{value:.3g} {unit} +- {error:.2g} {unit}"
+
+
+
+"""
+    This function is used to output the image from the database that matches the input image being processed. 
+    The image is then displayed onto the GUI next to the input image. Since this function does a lot, I have
+    provided a step-by-step explaination below:
+
+        The function performs the following steps:
+        1. Takes the refined thickness, tilt and their uncertainties from the MatchResult of the Database module and keeps
+           the whole result in the global variables (globalVariables['matchResult']).
+        2. Constructs strings with the format 'best +- error nm' and 'best +- error mrad'.
+        3. Updates the measurements and results in the global variables with the material, thickness, tilt and confidence.
+        4. Updates the table in the GUI with the new measurements and results.
+        5. Displays the input image and the best fit image in the GUI. Simulations from a pattern store have no image
+           file, their image in the simulation library is shown instead.
+
+    Parameters:
+    ----------
+    match : Database.MatchResult
+        The result of matching the image against the simulation library in Database.directory_path.
+
+    globalVariables : dict
+        A dictionary containing global variables.
+
+    Returns:
+    -------
+    None
+"""
+def show_thickness(match, globalVariables):
+    globalVariables['matchResult'] = match
+    final_value = format_estimate(match.thickness, match.thickness_error, "nm")
+    best_fit_image = match.best_fit_path(Database.directory_path)
     
     # Initialize an empty list to store data
     data = []
     thickness = final_value
+    tilt = format_estimate(match.tilt, match.tilt_error, "mrad")
+    confidence = "unknown" if np.isnan(match.confidence) else f"{match.confidence:.2f}"
     material = "Silicon" # Right now, this is hardcoded data because we will be using the same material for all simulations for now
-    globalVariables['measurements'].extend(['Material', 'Thickness'])
-    globalVariables['results'].extend([material, thickness])
+    globalVariables['measurements'].extend(['Material', 'Thickness', 'Mistilt', 'Confidence'])
+    globalVariables['results'].extend([material, thickness, tilt, confidence])
 
     # Create a list of dictionaries with measurement results
     for measurement, result in zip(globalVariables['measurements'], globalVariables['results']):
@@ -515,17 +657,22 @@ def output_image(globalVariables):
     df = pd.DataFrame(data)
 
     # Update the table
-    table.updateModel(TableModel(df))
-    table.redraw()
+    with timing.stage('gui_table'):
+        table.updateModel(TableModel(df))
+        table.redraw()
 
     input_img_label.config(image = globalVariables['loadedImage'])
     input_img_label.image = globalVariables['loadedImage']
     if globalVariables['updateOutputImage'] == True:
-        if os.path.exists(best_fit_image):
-            globalVariables['outputImg'] = Image.open(best_fit_image)
+        with timing.stage('gui_best_fit_image', file = match.file):
+            if best_fit_image is not None:
+                globalVariables['outputImg'] = Image.open(best_fit_image)
+            else:
+                globalVariables['outputImg'] = Image.fromarray(match.image)
+            Figure, FigureCanvasTkAgg = figure_classes()
             fig = Figure(figsize =  (3, 3))
             ax = fig.add_subplot(111)
-            ax.imshow(globalVariables['outputImg'])
+            ax.imshow(globalVariables['outputImg'], cmap = 'gray')
             ax.axis('off')
 
             # Removes the white space around the image
@@ -538,13 +685,44 @@ def output_image(globalVariables):
             outputImg_label.config(image = globalVariables['loadedImage'])
             outputImg_label.image = globalVariables['loadedImage']
             globalVariables['updateOutputImage'] = False
-        else:
-            messagebox.showerror("Error", "No output image found.")
 
     determine_thickness_button.config(state = 'disabled')    
 
 
 
+"""
+    This function shows the CNN thickness estimate in the results table. There is no best fit simulation image
+    for a CNN estimate, so only the table is updated.
+
+    Parameters:
+    ----------
+    estimate : dict
+        The estimate from Database.cnn_estimate: thickness, confidence, top_thicknesses and top_probabilities.
+
+    globalVariables : dict
+        A dictionary containing global variables.
+
+    Returns:
+    -------
+    None
+"""
+def show_cnn_estimate(estimate, globalVariables):
+    thickness = f"{estimate['thickness']:g} nm (CNN, {estimate['confidence']:.0%} confidence)"
+    alternatives = ", ".join(f"{t:g} nm ({p:.0%})" for t, p in zip(estimate['top_thicknesses'], estimate['top_probabilities']))
+    material = "Silicon" # Right now, this is hardcoded data because we will be using the same material for all simulations for now
+    globalVariables['measurements'].extend(['Material', 'Thickness', 'CNN Top Thicknesses'])
+    globalVariables['results'].extend([material, thickness, alternatives])
+
+    # Create a DataFrame with the measurement results and update the table
+    df = pd.DataFrame({'Simulation Measurements': globalVariables['measurements'], 'Simulation Results': globalVariables['results']})
+    with timing.stage('gui_table'):
+        table.updateModel(TableModel(df))
+        table.redraw()
+
+    determine_thickness_button.config(state = 'disabled')
+
+
+
 """
     This function saves the output image to a user-specified location. The user is prompted to select a location 
     and provide a name for the file.
@@ -571,6 +749,88 @@ def save_image(globalVariables):
 
 
 
+"""
+    This function returns the matplotlib classes used to draw the images. matplotlib is imported the first time
+    an image is shown (or by preload_modules) instead of when the GUI starts.
+
+    Parameters:
+    ----------
+    None
+
+    Returns:
+    -------
+    tuple
+        The Figure class and the FigureCanvasTkAgg class.
+"""
+def figure_classes():
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+    from matplotlib.figure import Figure
+    return Figure, FigureCanvasTkAgg
+
+
+
+"""
+    This function imports the modules that are loaded lazily (matplotlib, scipy) on a background thread once the 
+    window is shown, so the first thickness determination does not wait for them. Errors are ignored, they are
+    raised again when the module is actually used.
+
+    Parameters:
+    ----------
+    cnn : bool
+        Whether to also load TensorFlow and the CNN model.
+
+    Returns:
+    -------
+    None
+"""
+def preload_modules(cnn = False):
+    try:
+        figure_classes()
+        Database.preload(cnn = cnn)
+    except Exception:
+        pass
+
+
+
+"""
+    This function starts loading the CNN model in the background when a method using the CNN is selected.
+
+    Parameters:
+    ----------
+    event : tkinter.Event
+        The combobox selection event.
+
+    Returns:
+    -------
+    None
+"""
+def on_method_selected(event):
+    if method_variable.get() != "MSE scan":
+        threading.Thread(target = preload_modules, kwargs = {'cnn': True}, daemon = True).start()
+
+
+
+"""
+    This function prints, as one JSON line, the time from the start of the imports until the window was first drawn,
+    the time until the whole window (with the table) is ready and the modules that were loaded when the window was
+    first drawn, then closes the window. It is only used when the TEM_STARTUP_BENCHMARK environment variable is set.
+
+    Parameters:
+    ----------
+    None
+
+    Returns:
+    -------
+    None
+"""
+def report_startup():
+    window.update()
+    print(json.dumps({'window_seconds': WINDOW_TIME - STARTUP_TIME, 'ready_seconds': time.perf_counter() - STARTUP_TIME,
+        'modules': WINDOW_MODULES}), flush = True)
+    on_window_close()
+
+
+
 """
     This function is used to close the GUI window.
 
@@ -698,6 +958,33 @@ save_button.bind("<Enter>", on_enter)
 save_button.bind("<Leave>", on_leave)
 save_button.grid(row = 1, column = 1, padx = 10, pady = 10, sticky = "se")
 
+# Method used by the Determine Thickness button
+method_frame = tk.Frame(left_frame)
+method_frame.grid(row = 1, column = 1, padx = 10, pady = 10, sticky = "sw")
+
+method_label = tk.Label(method_frame, text = "Method:", font = 15)
+method_label.pack(side = 'left', padx = 5)
+
+method_variable = tk.StringVar(value = MATCH_METHODS[0])
+method_box = ttk.Combobox(method_frame, textvariable = method_variable, values = MATCH_METHODS, state = 'readonly', width = 15)
+method_box.pack(side = 'left', padx = 5)
+method_box.bind('<<ComboboxSelected>>', on_method_selected)
+
+# Progress bar and Cancel button, only shown while the thickness is being determined
+progress_frame = tk.Frame(left_frame)
+progress_frame.grid(row = 1, column = 0, padx = 10, pady = 10, sticky = "sw")
+
+progress_bar = ttk.Progressbar(progress_frame, orient = 'horizontal', mode = 'determinate', length = 300)
+progress_bar.pack(side = 'left', padx = 5)
+
+cancel_button = tk.Button(progress_frame, text = "Cancel", relief = "raised", fg = 'black', bg = 'light gray', height = 2, width = 15, font = 15, 
+    command = lambda: cancel_thickness(globalVariables))
+
+cancel_button.bind("<Enter>", on_enter)
+cancel_button.bind("<Leave>", on_leave)
+cancel_button.pack(side = 'left', padx = 5)
+progress_frame.grid_remove()
+
 
 # Right frame for table view
 right_frame = tk.Frame(window)
@@ -711,6 +998,13 @@ data = {
 
 df = pd.DataFrame(data)
 
+# Draw the window before the table is created: pandastable imports matplotlib, which takes longer than the rest
+# of the GUI together. The time and the modules loaded at this point are what the startup benchmark checks
+window.update()
+WINDOW_TIME = time.perf_counter()
+WINDOW_MODULES = sorted(sys.modules)
+from pandastable import Table, TableModel
+
 table = Table(right_frame, dataframe = df,
     showtoolbar = True,
     showstatusbar = True,
@@ -722,4 +1016,9 @@ table = Table(right_frame, dataframe = df,
     rowselectedcolor = 'light blue')
 table.show()
 
+# The window is drawn first, the heavy modules are then imported in the background
+threading.Thread(target = preload_modules, daemon = True).start()
+if os.environ.get(STARTUP_BENCHMARK_ENV):
+    window.after_idle(report_startup)
+
 window.mainloop()
@@ -10,163 +10,331 @@ import matplotlib.pyplot as plt                         # to create plots
 from scipy.spatial.transform import Rotation as R       # to generate rotations for mistilt simulations
 from tqdm import tqdm                                   # to loop over each rotation
 from PIL import Image                                   # for TIFF formatting
-
-print(py4DSTEM.__version__)
+import copy                                             # to give each simulation session its own material
+import weakref                                          # to cache the sessions of a material while it exists
+import os
+import time                                            # to report the simulation farm speed
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed    # to run the simulation farm over all cores
+from pattern_store import PatternStore                  # to store raw PACBED intensity arrays
 
 # function to create material structure from data
-def defMaterial(positions, numbers, cell):
+def defMaterial(positions, numbers, cell, plot = True):
     material = py4DSTEM.process.diffraction.Crystal(positions, numbers, cell)
-    material.plot_structure(figsize=(4,4))
+    if plot:
+        material.plot_structure(figsize=(4,4))
     return material
 
 # function to find 2 orthogonal axes to an axis for mistilt simulations
-def findOrthogAxes(zoneAxis):
+# the random vector they are built from is seeded, so the same zone axis always gives the same basis
+def findOrthogAxes(zoneAxis, seed = 0):
     za = np.array(zoneAxis)
-    x = np.random.randn(3)      # create a 3D vector
+    rng = np.random.default_rng(seed)
 
     # use cross products to find orthogonals vectors
-    o1 = np.cross(za, x)
+    o1 = np.zeros(3)
+    while np.linalg.norm(o1) < 1e-6:       # draw again in the unlikely case the vector is parallel to the zone axis
+        o1 = np.cross(za, rng.standard_normal(3))      # cross with a random 3D vector
     o2 = np.cross(za, o1)
 
     o1, o2 = o1 / np.linalg.norm(o1), o2 / np.linalg.norm(o2)   # normalize
 
     return o1, o2       # return vectors
 
-# function to create the PACBED simulations
-# use default values that can be overwritten for all parameters except material and thickness
-def simImg(material, thickness, mistilt = 0, tiltStep = 0, zoneAxis = [0, 1, 1], accV = 200e3, semiAngle = 9.75, angleStep = 0):
-    material.calculate_structure_factors(k_max=2.0, tol_structure_factor=0.0)   # calculate structure factors for material
-
-    # convert the V_g to relativistic-corrected U_g
-    material.calculate_dynamical_structure_factors(accV, "WK-CP", k_max=2.0, thermal_sigma=0.08, tol_structure_factor=0.0)
-
-    # create diffraction pattern for matrix of beams
-    beams = material.generate_diffraction_pattern(zone_axis_lattice=zoneAxis, tol_intensity=0., k_max=2.5, tol_excitation_error_mult=1)
-
-    thickness *= 10     # thickness in e-10m for py4DSTEM functions
-
-    # method for 0-tilt simulation
-    if (mistilt == 0):
-        # plot diffraction pattern
-        py4DSTEM.process.diffraction.plot_diffraction_pattern(
-            beams,
-            scale_markers=1000,
-            shift_labels=0.05,
-            min_marker_size=0,
-            figsize = (4,4),
-        )
-
-        # generate the PACBED pattern
-        DP = material.generate_CBED(
-            beams,
+# function to find the tilted zone axes of a tiltStep x tiltStep grid of tilts from 0 to mistilt (mrad)
+# about two orthogonal axes, in the same order as the step numbers of the saved patterns
+# all rotations are built and applied in one batch, returns an (tiltStep * tiltStep, 3) array
+def tiltedZoneAxes(zoneAxis, mistilt, tiltStep, seed = 0):
+    rotAxis1, rotAxis2 = findOrthogAxes(zoneAxis, seed)     # both axes from the same basis
+
+    # create matrix of rotations
+    tilt1, tilt2 = np.meshgrid(
+        np.linspace(0, mistilt, tiltStep), np.linspace(0, mistilt, tiltStep)
+    )
+
+    # generate the rotations, one rotation vector per grid point
+    Ra = R.from_rotvec(tilt1.reshape(-1, 1) / 1000.0 * rotAxis1)
+    Rb = R.from_rotvec(tilt2.reshape(-1, 1) / 1000.0 * rotAxis2)
+    return (Ra * Rb).apply(zoneAxis)    # rotate the original zone axis
+
+# function to build the file name (without extension) of a PACBED simulation
+# thickness in nm, mistilt in mrad, step is the 1-based tilt grid index for tilted simulations
+def patternName(thickness, mistilt = 0, tiltStep = 0, step = None):
+    name = f"{thickness:0.0f} nm_{mistilt:0.0f}mrad_{tiltStep:0.0f}steps"
+    if step is not None:
+        name += f"_step{step:0.0f}"
+    return name
+
+# function to save a PACBED pattern as figure images, TIFF and PNG by default
+def savePattern(DP, name, formats = (".tif", ".png")):
+    # plot PACBED pattern
+    fig,ax = py4DSTEM.visualize.show(
+        DP,
+        ticks = False,
+        mask_alpha = 0.99,
+        returnfig=True
+    )
+
+    # save PACBED pattern image files
+    for extension in formats:
+        fig.savefig(name + extension)
+    plt.close(fig)      # release the figure, sweeps save hundreds of them
+
+# function to write a PACBED pattern
+# without a store it is saved as TIFF and PNG figure images, with a PatternStore the raw intensity array is
+# added to the store together with its simulation parameters and a PNG preview is only saved if preview is True
+def writePattern(DP, name, store = None, preview = True, **metadata):
+    if store is None:
+        savePattern(DP, name)
+        return
+
+    store.append(os.path.basename(name), DP, **metadata)
+    if preview:
+        savePattern(DP, name, (".png",))
+
+# class to reuse the structure factors and beams of a material for every pattern of a sweep
+# they only depend on the material, voltage, zone axis and k_max, only the CBED step depends on the thickness
+class SimulationSession:
+    def __init__(self, material, accV = 200e3, zoneAxis = [0, 1, 1], k_max = 2.0, beamKMax = 2.5):
+        # the structure factors are stored on the material, so each session works on its own copy
+        self.material = copy.deepcopy(material)
+        self.accV = accV
+        self.zoneAxis = list(zoneAxis)
+        self.k_max = k_max
+
+        self.material.calculate_structure_factors(k_max=k_max, tol_structure_factor=0.0)   # calculate structure factors for material
+
+        # convert the V_g to relativistic-corrected U_g
+        self.material.calculate_dynamical_structure_factors(accV, "WK-CP", k_max=k_max, thermal_sigma=0.08, tol_structure_factor=0.0)
+
+        # create diffraction pattern for matrix of beams
+        self.beams = self.material.generate_diffraction_pattern(zone_axis_lattice=self.zoneAxis, tol_intensity=0., k_max=beamKMax, tol_excitation_error_mult=1)
+
+    # generate the 0-tilt PACBED pattern for a thickness in nm, or a list of patterns for a list of thicknesses
+    # the Bloch wave calculation is shared by all thicknesses of one call
+    def cbed(self, thickness, semiAngle = 9.75):
+        if np.isscalar(thickness):
+            thickness = thickness * 10      # thickness in e-10m for py4DSTEM functions
+        else:
+            thickness = [t * 10 for t in thickness]
+
+        return self.material.generate_CBED(
+            self.beams,
             thickness=thickness,
             alpha_mrad=semiAngle,
             pixel_size_inv_A=0.01,
             DP_size_inv_A=1.1,
-            zone_axis_lattice=zoneAxis,
-        )
-
-        # plot PACBED pattern
-        fig,ax = py4DSTEM.visualize.show(
-            DP,
-            ticks = False,
-            mask_alpha = 0.99,
-            returnfig=True
+            zone_axis_lattice=self.zoneAxis,
         )
 
-        # save PACBED pattern image as TIFF and PNG files
-        fig.savefig(f"{(thickness/10):0.0f} nm_{(mistilt):0.0f}mrad_{(tiltStep):0.0f}steps.tif")
-        fig.savefig(f"{(thickness/10):0.0f} nm_{(mistilt):0.0f}mrad_{(tiltStep):0.0f}steps.png")
-
-    # method for tilted simulations
-    else:
-        # get two orthogonal axes to the zone axis
-        rotAxis1 = findOrthogAxes(zoneAxis)[0]
-        rotAxis2 = findOrthogAxes(zoneAxis)[1]
-
-        rot1, rot2 = mistilt, mistilt
-
-        # create matrix of rotations
-        tilt1, tilt2 = np.meshgrid(
-            np.linspace(0, rot1, tiltStep), np.linspace(0, rot2, tiltStep)
+    # generate the PACBED pattern for a thickness in nm along a tilted zone axis, or a list of patterns for a list of thicknesses
+    # generate_CBED only takes the beam indices and positions from its beams, so the session beams are used directly
+    # and no separate dynamical diffraction pattern has to be calculated for the tilt
+    def tiltedCBED(self, thickness, tiltedZA, semiAngle = 9.75):
+        if np.isscalar(thickness):
+            thickness = thickness * 10      # thickness in e-10m for py4DSTEM functions
+        else:
+            thickness = [t * 10 for t in thickness]
+
+        # generate the PACBED pattern for this tilt
+        return self.material.generate_CBED(
+            self.beams,
+            thickness=thickness,
+            alpha_mrad=semiAngle,
+            pixel_size_inv_A=0.01,
+            DP_size_inv_A=1.1,
+            zone_axis_lattice=tiltedZA,
+            progress_bar=False,
         )
 
-        fig,ax = plt.subplots(tiltStep, tiltStep, figsize=(12, 12.1))       # create subplotting for matrix of rotations in a grid for plot
+    # generate the PACBED patterns of a tilt series, one per tilted zone axis (see tiltedZoneAxes)
+    # with a list of thicknesses every tilt returns a list of patterns sharing one Bloch wave calculation
+    def tiltSeries(self, thickness, tiltedZAs, semiAngle = 9.75):
+        return [self.tiltedCBED(thickness, tiltedZA, semiAngle) for tiltedZA in tqdm(tiltedZAs, unit="tilt")]
+
+    # simulation parameters of a pattern of this session, as stored in a PatternStore
+    def patternMetadata(self, thickness, semiAngle = 9.75, mistilt = 0, tiltStep = 0, step = None):
+        return dict(thickness=thickness, mistilt=mistilt, tilt_steps=tiltStep, step=step or 0, voltage=self.accV / 1000,
+                    zone_axis="".join(str(index) for index in self.zoneAxis), convergence_angle=semiAngle)
+
+    # generate and save the 0-tilt PACBED patterns for every thickness (nm) of a sweep
+    # with a PatternStore the raw arrays are stored instead of figure images (see writePattern)
+    def sweep(self, thicknesses, semiAngle = 9.75, store = None, preview = True):
+        thicknesses = list(thicknesses)
+        DPs = self.cbed(thicknesses, semiAngle)
+        for thickness, DP in zip(thicknesses, DPs):
+            writePattern(DP, patternName(thickness), store, preview, **self.patternMetadata(thickness, semiAngle))
+        return DPs
+
+# sessions already created for each material, keyed by voltage, zone axis and k_max
+# the material object itself is the key, held weakly, so the sessions of a material go away with it and a new
+# material can never be handed the sessions of an old one
+sessions = weakref.WeakKeyDictionary()
+
+# function to get the simulation session for a material, creating it the first time it is needed
+def getSession(material, accV = 200e3, zoneAxis = [0, 1, 1], k_max = 2.0):
+    materialSessions = sessions.setdefault(material, {})
+    key = (accV, tuple(zoneAxis), k_max)
+    if key not in materialSessions:
+        materialSessions[key] = SimulationSession(material, accV, zoneAxis, k_max)
+    return materialSessions[key]
 
-        # normalize axes
-        rotAxis1 = np.array(rotAxis1) / np.linalg.norm(rotAxis1)
-        rotAxis2 = np.array(rotAxis2) / np.linalg.norm(rotAxis2)
-
-        # arrays to store each pattern and tilted zone axis for PACBED patterns
-        patterns = []
-        tiltedZAs = []
-
-        # loop over all the tilt values and the subplots together
-        for ta, tb, a in tqdm(zip(tilt1.flat, tilt2.flat, ax.flat)):
-
-            # generate the rotations
-            Ra = R.from_rotvec(ta / 1000.0 * rotAxis1)
-            Rb = R.from_rotvec(tb / 1000.0 * rotAxis2)
-
-            tiltedZA = (Ra * Rb).apply(zoneAxis)    # rotate the original zone axis
-
-            # generate diffraction pattern for this tilt
-            pattern = Si.generate_dynamical_diffraction_pattern(
-                beams=beams, thickness=thickness, zone_axis_lattice=tiltedZA
-            )
+# function to create the PACBED simulations
+# use default values that can be overwritten for all parameters except material and thickness
+# the structure factors and beams are reused from the simulation session of the material
+# with a PatternStore the raw arrays are stored instead of figure images (see writePattern)
+# plot = False skips the diffraction pattern plots, which for dense tilt grids take longer than the simulations
+def simImg(material, thickness, mistilt = 0, tiltStep = 0, zoneAxis = [0, 1, 1], accV = 200e3, semiAngle = 9.75, angleStep = 0, store = None, preview = True, plot = True):
+    session = getSession(material, accV, zoneAxis)
+    beams = session.beams
 
-            # plot the pattern in the correct axes in the figure
+    # method for 0-tilt simulation
+    if (mistilt == 0):
+        # plot diffraction pattern
+        if plot:
             py4DSTEM.process.diffraction.plot_diffraction_pattern(
-                pattern,
-                scale_markers=500,
-                input_fig_handle=(fig, (a,)),
-                add_labels=False,
-                max_marker_size = 30,
-            )
-
-            # store pattern and tilted zone axis for this tilt
-            patterns.append(pattern)
-            tiltedZAs.append(tiltedZA)
-
-            # set plot details for this tilt
-            a.get_xaxis().set_ticks([])
-            a.get_yaxis().set_ticks([])
-            a.set_xlabel(None)
-            a.set_ylabel(None)
-
-        # plot rotated diffraction patterns in matrix grid
-        plt.subplots_adjust(wspace=0, hspace=0)
-        plt.show()
-
-        print(len(patterns), len(tiltedZAs))    # confirm number of patterns and tilted zone axes match number of diffraction patterns
-                                                # should be the same number
-
-        # loop through each diffraction image
-        for i in range(len(patterns)):
-            # generate the PACBED pattern for this image
-            DP = material.generate_CBED(
-                patterns[i],
-                thickness=thickness,
-                alpha_mrad=semiAngle,
-                pixel_size_inv_A=0.01,
-                DP_size_inv_A=1.1,
-                zone_axis_lattice=tiltedZAs[i],
+                beams,
+                scale_markers=1000,
+                shift_labels=0.05,
+                min_marker_size=0,
+                figsize = (4,4),
             )
 
-            # plot PACBED pattern for this image
-            fig,ax = py4DSTEM.visualize.show(
-                DP,
-                ticks = False,
-                mask_alpha = 0.99,
-                returnfig=True
-            )
+        # generate the PACBED pattern
+        DP = session.cbed(thickness, semiAngle)
 
-            # save PACBED pattern image for this diffraction image as TIFF and PNG files
-            fig.savefig(f"{(thickness/10):0.0f} nm_{(mistilt):0.0f}mrad_{(tiltStep):0.0f}steps_step{(i+1):0.0f}.tif")
-            fig.savefig(f"{(thickness/10):0.0f} nm_{(mistilt):0.0f}mrad_{(tiltStep):0.0f}steps_step{(i+1):0.0f}.png")
+        # save PACBED pattern
+        writePattern(DP, patternName(thickness, mistilt, tiltStep), store, preview, **session.patternMetadata(thickness, semiAngle))
 
-# Silicon material
-Si = defMaterial(
+    # method for tilted simulations
+    else:
+        # tilted zone axes of the whole grid, from one seeded orthogonal basis
+        tiltedZAs = tiltedZoneAxes(zoneAxis, mistilt, tiltStep)
+
+        if plot:
+            fig,ax = plt.subplots(tiltStep, tiltStep, figsize=(12, 12.1))       # create subplotting for matrix of rotations in a grid for plot
+
+            # loop over all the tilted zone axes and the subplots together
+            for tiltedZA, a in zip(tiltedZAs, ax.flat):
+                # generate diffraction pattern for this tilt
+                pattern = session.material.generate_dynamical_diffraction_pattern(
+                    beams=beams, thickness=thickness * 10, zone_axis_lattice=tiltedZA
+                )
+
+                # plot the pattern in the correct axes in the figure
+                py4DSTEM.process.diffraction.plot_diffraction_pattern(
+                    pattern,
+                    scale_markers=500,
+                    input_fig_handle=(fig, (a,)),
+                    add_labels=False,
+                    max_marker_size = 30,
+                )
+
+                # set plot details for this tilt
+                a.get_xaxis().set_ticks([])
+                a.get_yaxis().set_ticks([])
+                a.set_xlabel(None)
+                a.set_ylabel(None)
+
+            # plot rotated diffraction patterns in matrix grid
+            plt.subplots_adjust(wspace=0, hspace=0)
+            plt.show()
+
+        # generate the PACBED pattern for every tilt
+        DPs = session.tiltSeries(thickness, tiltedZAs, semiAngle)
+
+        # loop through each tilt
+        for i, DP in enumerate(DPs):
+            # save PACBED pattern for this tilt
+            writePattern(DP, patternName(thickness, mistilt, tiltStep, i + 1), store, preview,
+                         **session.patternMetadata(thickness, semiAngle, mistilt, tiltStep, i + 1))
+
+# simulation farm: every PACBED pattern is an independent work item (thickness, mistilt, tiltStep, step, tilted zone axis)
+# that is simulated on a pool of processes, each with its own simulation session
+
+# file in the output directory listing the finished patterns, so a stopped farm resumes where it left off
+CHECKPOINT_FILENAME = "farm_checkpoint.txt"
+
+# function to list the work items for a set of thicknesses (nm), either 0-tilt or over a tilt grid
+def workItems(thicknesses, mistilt = 0, tiltStep = 0, zoneAxis = [0, 1, 1]):
+    if mistilt == 0:
+        return [(thickness, 0, 0, None, list(zoneAxis)) for thickness in thicknesses]
+
+    # the tilted zone axes are computed once so that every worker uses the same tilt grid
+    tiltedZAs = tiltedZoneAxes(zoneAxis, mistilt, tiltStep)
+    return [(thickness, mistilt, tiltStep, i + 1, list(tiltedZA))
+            for thickness in thicknesses for i, tiltedZA in enumerate(tiltedZAs)]
+
+# session of the current farm worker process
+farmSession = None
+
+# function run once in every farm worker process to create its material and simulation session
+def initFarmWorker(structure, accV, zoneAxis, k_max):
+    global farmSession
+    import matplotlib
+    matplotlib.use("Agg")       # workers only save figures
+    farmSession = SimulationSession(defMaterial(*structure, plot = False), accV, zoneAxis, k_max)
+
+# function run in a farm worker process to simulate one pattern
+# without a store the pattern is saved as figure images here and only its name is returned,
+# with a store the raw array is returned as well so the main process can add it to the store
+def simulateItem(item, semiAngle, outputDir, toStore = False, preview = True):
+    thickness, mistilt, tiltStep, step, tiltedZA = item
+    if step is None:
+        DP = farmSession.cbed(thickness, semiAngle)
+    else:
+        DP = farmSession.tiltedCBED(thickness, tiltedZA, semiAngle)
+
+    name = patternName(thickness, mistilt, tiltStep, step)
+    if not toStore:
+        savePattern(DP, os.path.join(outputDir, name))
+        return name, None, None
+
+    if preview:
+        savePattern(DP, os.path.join(outputDir, name), (".png",))
+    return name, DP, farmSession.patternMetadata(thickness, semiAngle, mistilt, tiltStep, step)
+
+# function to run the simulation farm for a list of work items
+# structure is the (positions, numbers, cell) of the material, workers defaults to one process per core
+# patterns listed in the checkpoint file of outputDir are skipped, so an interrupted farm can simply be restarted
+# with a store directory the raw arrays are written to a PatternStore there instead of figure images, and the
+# patterns already in the store are the ones skipped
+def runFarm(structure, items, outputDir = ".", workers = None, accV = 200e3, zoneAxis = [0, 1, 1], semiAngle = 9.75, k_max = 2.0, store = None, preview = True):
+    os.makedirs(outputDir, exist_ok=True)
+    checkpointPath = os.path.join(outputDir, CHECKPOINT_FILENAME)
+    if store is not None:
+        store = PatternStore(store)
+        done = set(store.names())
+    elif os.path.exists(checkpointPath):
+        with open(checkpointPath) as checkpoint:
+            done = set(line.strip() for line in checkpoint)
+    else:
+        done = set()
+
+    pending = [item for item in items if patternName(*item[:4]) not in done]
+    print(f"{len(items) - len(pending)} of {len(items)} patterns already simulated")
+    if not pending:
+        return
+
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=workers, initializer=initFarmWorker, initargs=(structure, accV, zoneAxis, k_max)) as pool:
+        futures = [pool.submit(simulateItem, item, semiAngle, outputDir, store is not None, preview) for item in pending]
+        if store is not None:
+            with store:     # flushed on the way out, also when the farm is interrupted
+                for future in tqdm(as_completed(futures), total=len(futures), unit="pattern"):
+                    name, DP, metadata = future.result()
+                    store.append(name, DP, **metadata)
+        else:
+            with open(checkpointPath, "a") as checkpoint:
+                for future in tqdm(as_completed(futures), total=len(futures), unit="pattern"):
+                    checkpoint.write(future.result()[0] + "\n")
+                    checkpoint.flush()      # record each finished pattern right away
+
+    elapsed = time.time() - start
+    print(f"{len(pending)} patterns in {elapsed:0.1f} s ({len(pending) / elapsed:0.2f} patterns per second)")
+
+# Silicon material structure (positions, atomic numbers, lattice constant)
+SI_STRUCTURE = (
     [[0.25, 0.75, 0.25],
      [0.0,  0.0,  0.5],
      [0.25, 0.25, 0.75],
@@ -179,11 +347,52 @@ Si = defMaterial(
     5.468728
 )
 
-# loop through 1-120 nm and generate 0-tilt PACBED simulation
-for i in range(1, 121):
-    # no mistilt
-    simImg(Si, i)
+# materials already created, keyed by their structure, so a long running process builds each material once
+materials = {}
+
+# function to get the material of a structure (positions, atomic numbers, lattice constant), creating it the first time
+def getMaterial(structure = SI_STRUCTURE):
+    key = repr(structure)
+    if key not in materials:
+        materials[key] = defMaterial(*structure, plot = False)
+    return materials[key]
+
+# work items of the default simulation library: 0-tilt for 1-120 nm and two tilted examples
+def defaultItems():
+    items = workItems(range(1, 121))
+    items += workItems([20], 10, 5)     # 20nm thickness, 10mrad mistilt, 5 tilt steps
+    items += workItems([60], 15, 4)     # 60nm thickness, 15mrad mistilt, 4 tilt steps
+    return items
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Generate the PACBED simulation library.")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes, more than 1 runs the simulation farm")
+    parser.add_argument("--output", default=".", help="directory for the simulation farm output")
+    parser.add_argument("--store", help="store the raw intensity arrays in this pattern store directory instead of figure images")
+    parser.add_argument("--no-preview", dest="preview", action="store_false", help="with --store, do not save PNG previews")
+    args = parser.parse_args(argv)
+
+    print(py4DSTEM.__version__)
+
+    if args.workers > 1:
+        # same library as below, simulated in parallel and resumable
+        runFarm(SI_STRUCTURE, defaultItems(), args.output, args.workers, store=args.store, preview=args.preview)
+    else:
+        store = PatternStore(args.store) if args.store else None
+
+        # Silicon material
+        Si = defMaterial(*SI_STRUCTURE)
+
+        # generate 0-tilt PACBED simulations for 1-120 nm, sharing the structure factors and beams of one session
+        getSession(Si).sweep(range(1, 121), store=store, preview=args.preview)
+
+        # generate tilted PACBED simulations examples
+        simImg(Si, 20, 10, 5, store=store, preview=args.preview)       # 20nm thickness, 10mrad mistilt, 5 tilt steps
+        simImg(Si, 60, 15, 4, store=store, preview=args.preview)       # 60nm thickness, 15mrad mistilt, 4 tilt steps
+
+        if store is not None:
+            store.flush()
+    return 0
 
-# generate tilted PACBED simulations examples
-simImg(Si, 20, 10, 5)       # 20nm thickness, 10mrad mistilt, 5 tilt steps
-simImg(Si, 60, 15, 4)       # 60nm thickness, 15mrad mistilt, 4 tilt steps
+if __name__ == "__main__":
+    main()
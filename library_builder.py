@@ -0,0 +1,145 @@
+# Incremental PACBED Simulation Library Builder
+# Keeps a manifest of every simulated grid point (material, voltage, zone axis, semi-angle, thickness, mistilt,
+# tilt steps, step) in a pattern store folder together with a hash of the simulation parameters, simulates only
+# the grid points that are missing and appends them to the matcher library and any feature index in that folder.
+#
+# Example, the 0-tilt library for 1-120 nm and then the same library grown to 150 nm plus a tilt grid at 20 nm:
+#     python library_builder.py simulations --thickness 1-120
+#     python library_builder.py simulations --thickness 1-150 --tilt 10:5:20
+
+# imports
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import os
+import sys
+
+import img_simulation
+import Database
+
+MANIFEST_FILENAME = 'library_manifest.csv'
+MANIFEST_FIELDS = ('material', 'voltage', 'zone_axis', 'semi_angle', 'thickness', 'mistilt', 'tilt_steps', 'step',
+                   'params_hash', 'name')
+
+# material structures (positions, atomic numbers, lattice constant) the builder can simulate
+MATERIALS = {'Si': img_simulation.SI_STRUCTURE}
+
+
+# hash of everything that changes the simulated patterns apart from the grid point itself
+def params_hash(structure, voltage, zone_axis, semi_angle, k_max):
+    params = {'structure': structure, 'voltage': voltage, 'zone_axis': list(zone_axis), 'semi_angle': semi_angle,
+              'k_max': k_max}
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+# parse a thickness list like "1-120,150,200" (nm, ranges inclusive)
+def parse_thicknesses(text):
+    thicknesses = []
+    for part in text.split(','):
+        if '-' in part:
+            start, stop = part.split('-')
+            thicknesses.extend(range(int(start), int(stop) + 1))
+        elif part:
+            thicknesses.append(int(part))
+    return thicknesses
+
+
+# parse a tilt grid like "10:5:20,60" into (mistilt mrad, tilt steps, thicknesses)
+def parse_tilt(text):
+    mistilt, steps, thicknesses = text.split(':')
+    return float(mistilt), int(steps), parse_thicknesses(thicknesses)
+
+
+def read_manifest(directory):
+    path = os.path.join(directory, MANIFEST_FILENAME)
+    if not os.path.exists(path):
+        return []
+    with open(path, newline='') as file:
+        return list(csv.DictReader(file))
+
+
+# rewrite the manifest through a temporary file of its own and swap it in (atomic_write), like PatternStore does
+# with its metadata table
+def write_manifest(directory, rows):
+    with Database.atomic_write(os.path.join(directory, MANIFEST_FILENAME), 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=MANIFEST_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+# manifest row of one farm work item
+def manifest_row(item, material, voltage, zone_axis, semi_angle, hash_value):
+    thickness, mistilt, tilt_steps, step, _ = item
+    return {'material': material, 'voltage': f'{voltage:g}', 'zone_axis': ''.join(str(i) for i in zone_axis),
+            'semi_angle': f'{semi_angle:g}', 'thickness': f'{thickness:g}', 'mistilt': f'{mistilt:g}',
+            'tilt_steps': str(tilt_steps), 'step': '' if step is None else str(step), 'params_hash': hash_value,
+            'name': img_simulation.patternName(*item[:4])}
+
+
+# grid point of a manifest row, the same for every row describing the same pattern
+def grid_key(row):
+    return tuple(row[field] for field in MANIFEST_FIELDS[:8])
+
+
+# simulate the grid points of a library folder that are not in its manifest yet and update the library
+# tilts is a list of (mistilt, tilt steps, thicknesses) grids, voltage is in kV and semi_angle in mrad
+# returns the number of newly simulated patterns
+def build(directory, material='Si', thicknesses=(), tilts=(), voltage=200, zone_axis=(0, 1, 1), semi_angle=9.75,
+          k_max=2.0, workers=None, preview=False):
+    structure = MATERIALS[material]
+    hash_value = params_hash(structure, voltage, zone_axis, semi_angle, k_max)
+
+    # the pattern names only hold the grid point, so one folder holds one set of simulation parameters
+    manifest = read_manifest(directory)
+    for row in manifest:
+        if (row['material'], row['params_hash']) != (material, hash_value):
+            raise ValueError(f"{directory} holds {row['material']} simulations with different simulation parameters "
+                             f"(hash {row['params_hash']}), use a separate folder for this library")
+
+    items = img_simulation.workItems(thicknesses, zoneAxis=list(zone_axis))
+    for mistilt, tilt_steps, tilt_thicknesses in tilts:
+        items += img_simulation.workItems(tilt_thicknesses, mistilt, tilt_steps, list(zone_axis))
+
+    existing = set(grid_key(row) for row in manifest)
+    rows = [manifest_row(item, material, voltage, zone_axis, semi_angle, hash_value) for item in items]
+    missing = [(item, row) for item, row in zip(items, rows) if grid_key(row) not in existing]
+    print(f"{len(items) - len(missing)} of {len(items)} grid points already in the library")
+
+    if missing:
+        img_simulation.runFarm(structure, [item for item, _ in missing], directory, workers, voltage * 1e3,
+                               list(zone_axis), semi_angle, k_max, store=directory, preview=preview)
+        manifest += [row for _, row in missing]
+        write_manifest(directory, manifest)
+
+    # convert and append the new patterns, and add them to every feature index already built for the folder
+    library = Database.SimulationLibrary.open(directory, voltage, ''.join(str(i) for i in zone_axis), semi_angle)
+    for index_path in glob.glob(os.path.join(directory, Database.INDEX_FILENAME.format('*'))):
+        method = Database.FeatureIndex.load(index_path).method
+        Database.FeatureIndex.open(directory, library, method)
+    return len(missing)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate the missing grid points of a PACBED simulation library.")
+    parser.add_argument('directory', help="pattern store folder of the library")
+    parser.add_argument('--material', choices=sorted(MATERIALS), default='Si')
+    parser.add_argument('--thickness', type=parse_thicknesses, default=[], help="0-tilt thicknesses in nm, e.g. 1-120,150")
+    parser.add_argument('--tilt', type=parse_tilt, action='append', default=[],
+                        help="tilt grid MISTILT:STEPS:THICKNESSES, e.g. 10:5:20 (can be repeated)")
+    parser.add_argument('--voltage', type=float, default=200, help="accelerating voltage in kV (default: 200)")
+    parser.add_argument('--zone-axis', default='011', help="zone axis as three digits (default: 011)")
+    parser.add_argument('--angle', type=float, default=9.75, help="convergence semi-angle in mrad (default: 9.75)")
+    parser.add_argument('--workers', type=int, help="simulation processes (default: one per core)")
+    parser.add_argument('--preview', action='store_true', help="also save PNG previews of the new patterns")
+    args = parser.parse_args(argv)
+
+    zone_axis = [int(digit) for digit in args.zone_axis]
+    build(args.directory, args.material, args.thickness, args.tilt, args.voltage, zone_axis, args.angle,
+          workers=args.workers, preview=args.preview)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
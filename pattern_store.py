@@ -0,0 +1,117 @@
+# PACBED Pattern Store
+# Raw simulated intensity arrays stored as a stack of chunked .npy files plus one metadata table,
+# written by img_simulation.py and read by Database.py without decoding any images.
+#
+# Layout of a store directory:
+#     chunk_00000.npy, chunk_00001.npy, ...   float32 arrays of shape (patterns in chunk, height, width)
+#     metadata.csv                            one row per pattern: name, chunk, row and the simulation parameters
+
+# imports
+import contextlib
+import csv
+import os
+import tempfile
+
+import numpy as np
+
+METADATA_FILENAME = 'metadata.csv'
+METADATA_FIELDS = ('name', 'chunk', 'row', 'thickness', 'mistilt', 'tilt_steps', 'step', 'voltage', 'zone_axis',
+                   'convergence_angle')
+
+
+# permissions of new files, mkstemp creates its files readable by their owner only
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+# open a file for writing through a temporary file with a unique name next to it, swapped in once it is complete
+# concurrent writers (threads or processes sharing a folder) each write their own temporary file, and readers,
+# including processes that have the old file memory mapped, never see a half written file
+# newline is passed on to open for text files, e.g. newline='' for csv
+@contextlib.contextmanager
+def atomic_write(path, mode='wb', newline=None):
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=name + '.', suffix='.tmp')
+    try:
+        os.chmod(temp_path, 0o666 & ~_umask)
+        with os.fdopen(fd, mode, newline=newline) as file:
+            yield file
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+
+
+class PatternStore:
+    def __init__(self, directory, chunk_size=256):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.rows = []          # metadata of every stored pattern, in order
+        self.pending = []       # patterns not yet written to a chunk
+        self.pendingRows = []
+
+        os.makedirs(directory, exist_ok=True)
+        metadataPath = os.path.join(directory, METADATA_FILENAME)
+        if os.path.exists(metadataPath):
+            with open(metadataPath, newline='') as file:
+                self.rows = list(csv.DictReader(file))
+        self.chunkCount = len(set(row['chunk'] for row in self.rows))
+
+    def __len__(self):
+        return len(self.rows) + len(self.pendingRows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    # names of the stored patterns, in order
+    def names(self):
+        return [row['name'] for row in self.rows + self.pendingRows]
+
+    # add one pattern, metadata holds any of the METADATA_FIELDS simulation parameters
+    # patterns are written to disk once a chunk is full or when the store is flushed
+    def append(self, name, pattern, **metadata):
+        row = {field: metadata.get(field, '') for field in METADATA_FIELDS}
+        row['name'] = name
+        self.pending.append(np.asarray(pattern, dtype=np.float32))
+        self.pendingRows.append(row)
+        if len(self.pending) >= self.chunk_size:
+            self.flush()
+
+    # write the pending patterns as a new chunk and rewrite the metadata table
+    def flush(self):
+        if not self.pending:
+            return
+        chunk = self.chunkCount
+        np.save(os.path.join(self.directory, f'chunk_{chunk:05d}.npy'), np.stack(self.pending))
+        for row_index, row in enumerate(self.pendingRows):
+            row['chunk'], row['row'] = chunk, row_index
+        self.rows += self.pendingRows
+        self.chunkCount += 1
+        self.pending, self.pendingRows = [], []
+
+        # write the table next to the old one and swap it in, so a crash never leaves a half written table
+        with atomic_write(os.path.join(self.directory, METADATA_FILENAME), 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=METADATA_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+    # metadata of every written pattern, one dict per pattern
+    def metadata(self):
+        return [dict(row) for row in self.rows]
+
+    # iterate over (metadata, pattern) of every written pattern, chunks are memory mapped and read one at a time
+    def __iter__(self):
+        return self.iterate()
+
+    # iterate over (metadata, pattern) of the written patterns from index start on
+    def iterate(self, start=0):
+        chunk, patterns = None, None
+        for row in self.rows[start:]:
+            if int(row['chunk']) != chunk:
+                chunk = int(row['chunk'])
+                patterns = np.load(os.path.join(self.directory, f'chunk_{chunk:05d}.npy'), mmap_mode='r')
+            yield dict(row), np.asarray(patterns[int(row['row'])])
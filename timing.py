@@ -0,0 +1,91 @@
+# Stage Timing and Profiling
+# Structured timing records for the stages of a thickness determination (preprocessing, library loading,
+# scoring, GUI rendering) written as JSON lines, plus optional cProfile dumps of whole runs.
+# Both are off unless switched on, by environment variable or by configure() from a command line flag:
+#     TEM_TIMING=timing.jsonl    append one JSON record per stage to this file ('-' for standard error)
+#     TEM_PROFILE=profiles       write a cProfile dump of every run to this directory
+#
+# A record looks like
+#     {"run": "3f2a9c1e", "stage": "score", "seconds": 0.412, "time": 1718000000.0, "thread": "MainThread", "simulations": 1200}
+
+# imports
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+TIMING_ENV = 'TEM_TIMING'
+PROFILE_ENV = 'TEM_PROFILE'
+
+log_path = os.environ.get(TIMING_ENV) or None
+profile_dir = os.environ.get(PROFILE_ENV) or None
+
+_lock = threading.Lock()
+_current = threading.local()    # id and name of the run of each thread
+
+
+# switch timing records and profiling on (or off with None), overriding the environment variables
+def configure(log=None, profile=None):
+    global log_path, profile_dir
+    log_path, profile_dir = log, profile
+
+
+def enabled():
+    return log_path is not None
+
+
+def write_record(record):
+    line = json.dumps(record, default=str) + '\n'
+    with _lock:
+        if log_path == '-':
+            sys.stderr.write(line)
+        else:
+            with open(log_path, 'a') as file:
+                file.write(line)
+
+
+# time one stage, fields are added to its record
+@contextlib.contextmanager
+def stage(name, **fields):
+    if log_path is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        write_record({'run': getattr(_current, 'id', None), 'stage': name, 'seconds': time.perf_counter() - start,
+                      'time': time.time(), 'thread': threading.current_thread().name, **fields})
+
+
+# one whole determination, e.g. one image: the stages inside it share a run id, the run gets a record of its own
+# and, when profiling is on, its cProfile dump is written as <profile_dir>/<name>_<run id>.prof
+@contextlib.contextmanager
+def run(name, **fields):
+    if log_path is None and profile_dir is None:
+        yield
+        return
+
+    outer = getattr(_current, 'id', None)
+    _current.id = uuid.uuid4().hex[:8]
+    profiler = None
+    if profile_dir is not None:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            profiler = None     # another profiler is already running in this thread
+    try:
+        with stage(name, **fields):
+            yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(profile_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(profile_dir, f'{name}_{_current.id}.prof'))
+        _current.id = outer